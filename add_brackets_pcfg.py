@@ -3,18 +3,23 @@ Add brackets to PCFG SET data.
 
 """
 
-def place_brackets(seq):
+import tasks
+
+UNARY_NAMES = set(func.__name__ for func in tasks.default.unary_functions)
+BINARY_NAMES = set(func.__name__ for func in tasks.default.binary_functions)
+
+def place_brackets(seq, unary_names=UNARY_NAMES, binary_names=BINARY_NAMES):
     if type(seq) is str:
         seq = seq.split()
     seq.append("END")
     queue = []
     new_seq = []
     for token in seq:
-        if token == "append" or token == "prepend":
+        if token in binary_names:
             new_seq.append(token)
             new_seq.append("(")
             queue.append(["two-place", 0])
-        elif token in ["copy", "reverse", "shift", "echo"]:
+        elif token in unary_names:
             new_seq.append(token)
             new_seq.append("(")
             queue.append(["one-place", 0])
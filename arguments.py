@@ -0,0 +1,125 @@
+"""
+Unique string arguments for PCFG SET.
+
+Every argument length has a counter, which is mapped to an argument through a keyed
+permutation of all len(alphabet) ** length arguments of that length. Arguments are
+therefore unique without keeping track of the ones handed out before, and running
+out of arguments of some length is known before drawing.
+
+"""
+
+import random
+
+MASK_64 = (1 << 64) - 1
+
+class ArgumentSpaceExhausted(Exception):
+    pass
+
+class KeyedPermutation():
+    """
+    Bijection on range(size): a balanced Feistel network over the smallest even
+    number of bits that covers size, restricted to range(size) by cycle walking.
+    """
+    def __init__(self, size, key, rounds=4):
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.shift = 64 - self.half_bits
+
+        rng = random.Random(key)
+        self.round_keys = [rng.getrandbits(64) for i in range(rounds)]
+        # Extra encryptions for values outside range(size), the cost of cycle walking
+        self.walks = 0
+
+    def encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.mask
+        for round_key in self.round_keys:
+            # Multiply-xorshift mix of the right half, keep the top bits
+            f = ((right ^ round_key) * 0x9E3779B97F4A7C15) & MASK_64
+            f = ((f ^ (f >> 32)) * 0xD6E8FEB86659FD93) & MASK_64
+            left, right = right, left ^ (f >> self.shift)
+        return((left << self.half_bits) | right)
+
+    def __getitem__(self, idx):
+        # The domain is less than 4 * size, so fewer than 4 steps are expected
+        x = self.encrypt(idx)
+        while x >= self.size:
+            x = self.encrypt(x)
+            self.walks += 1
+        return(x)
+
+class ArgumentAllocator():
+    """
+    Hands out unique string arguments per length. Allocators with the same key and
+    different shards (start, step) never hand out the same argument.
+    """
+    def __init__(self, alphabet, key, shard_idx=0, nr_shards=1):
+        self.alphabet = alphabet
+        self.key = key
+        self.start = shard_idx
+        self.step = nr_shards
+        self.permutations = {}
+        self.counters = {}
+
+    def shard(self, shard_idx, nr_shards):
+        self.start = shard_idx
+        self.step = nr_shards
+        self.counters = {}
+
+    def get_state(self):
+        return({'key' : self.key, 'start' : self.start, 'step' : self.step, 'counters' : dict(self.counters)})
+
+    def set_state(self, state):
+        if state['key'] != self.key:
+            # Permutations depend on the key, and are made again when needed
+            self.permutations = {}
+        self.key = state['key']
+        self.start = state['start']
+        self.step = state['step']
+        self.counters = dict(state['counters'])
+
+    def permutation(self, length):
+        # Counters may be set in advance, to continue where other allocators stopped
+        if not length in self.permutations:
+            size = len(self.alphabet) ** length
+            self.permutations[length] = KeyedPermutation(size, (self.key * 1000003 + length) & MASK_64)
+        if not length in self.counters:
+            self.counters[length] = self.start
+        return(self.permutations[length])
+
+    def nr_handed_out(self):
+        # Arguments drawn or reserved by this allocator, over all lengths
+        return(sum(max(counter - self.start, 0) // self.step for counter in self.counters.values()))
+
+    def nr_walks(self):
+        return(sum(permutation.walks for permutation in self.permutations.values()))
+
+    def remaining(self, length):
+        size = self.permutation(length).size
+        counter = self.counters[length]
+        if counter >= size:
+            return(0)
+        return((size - counter + self.step - 1) // self.step)
+
+    def available(self, lengths):
+        return([length for length in lengths if self.remaining(length) > 0])
+
+    def reserve(self, length):
+        # Use up one argument of this length without spelling it out (placeholders)
+        size = self.permutation(length).size
+        counter = self.counters[length]
+        if counter >= size:
+            raise ArgumentSpaceExhausted('No unused string arguments of length ' + str(length))
+        self.counters[length] = counter + self.step
+        return(counter)
+
+    def draw(self, length):
+        permutation = self.permutation(length)
+        idx = permutation[self.reserve(length)]
+
+        nr_letters = len(self.alphabet)
+        argument = []
+        for i in range(length):
+            idx, letter = divmod(idx, nr_letters)
+            argument += [self.alphabet[letter]]
+        return(argument)
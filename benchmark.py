@@ -0,0 +1,306 @@
+"""
+Benchmarks of the generation, interpretation and naturalization hot paths.
+
+Every benchmark runs at one or more scales: 10K (the shipped 10K corpus), 100K (the
+shipped 100K splits, topped up with generated samples where sources are missing) and
+1M (generated). Generated data comes from a MarkovTree with a fixed seed, so every run
+uses the same samples. Data is prepared once in the work directory and reused.
+
+For each benchmark and scale the number of samples per second (best of --repeat runs)
+and the peak memory allocated by Python (tracemalloc, in a separate run) are reported.
+Results can be saved as a baseline JSON and compared against one later; a slowdown or
+memory growth beyond the tolerance is reported as a regression (exit status 1).
+
+The cold start of the core generator is checked as well: importing generate, measured
+with python -X importtime in a fresh interpreter, has to stay within a time budget and
+must not load the naturalization stack (numpy, pandas, seaborn, matplotlib, requests).
+
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import tasks
+import tree_stats
+from add_brackets_pcfg import place_brackets
+from generate import MarkovTree, generate_data, sample_line
+from interpret_set import interpret, get_substructures, FUNC_NAMES
+from naturalize import DataNaturalization
+
+SHIPPED_10K = 'data/pcfg_set/10K/pcfg_10funcs_520letters_brackets.txt'
+SHIPPED_100K = 'data/pcfg_set/100K/random_split'
+
+# Minimum number of samples per scale; 10K is the shipped corpus as it is
+SCALES = {'10K' : None, '100K' : 100000, '1M' : 1000000}
+
+# Benchmarks on in-memory samples prepare at most this many and cycle through them
+MAX_PREPARED = 100000
+
+# Modules that only naturalization and plotting need
+HEAVY_MODULES = ['numpy', 'pandas', 'seaborn', 'matplotlib', 'requests', 'pycorenlp', 'naturalize']
+
+def markov_tree(seed=0):
+    task = tasks.default
+    alphabet = [letter + str(i) for letter in task.alphabet for i in range(1, 21)]
+    return(MarkovTree(unary_functions=task.unary_functions,
+                      binary_functions=task.binary_functions,
+                      alphabet=alphabet,
+                      prob_unary=0.75,
+                      prob_func=0.25,
+                      lengths=[2, 3, 4, 5],
+                      placeholders=False,
+                      omit_brackets=False,
+                      seed=seed,
+                      max_length=500,
+                      max_depth=20))
+
+def shipped_lines(scale):
+    # Bracketed source \t target lines of the shipped corpus of a scale
+    if scale == '10K':
+        with open(SHIPPED_10K, 'r') as f:
+            return(f.readlines())
+    lines = []
+    if scale == '100K':
+        for split in ['train', 'dev', 'test']:
+            src_file = os.path.join(SHIPPED_100K, split + '.src')
+            tgt_file = os.path.join(SHIPPED_100K, split + '.tgt')
+            if not os.path.exists(src_file) or not os.path.exists(tgt_file):
+                continue
+            with open(src_file, 'r') as fsrc, open(tgt_file, 'r') as ftgt:
+                for source, target in zip(fsrc, ftgt):
+                    lines.append(place_brackets(source.strip()) + '\t' + target)
+    return(lines)
+
+def placeholder_line(line):
+    return(' '.join(token if token in FUNC_NAMES or token in ['(', ')', ','] else 'X' for token in line.split('\t')[0].split()) + '\n')
+
+def prepare_scale(scale, work_dir):
+    # Data file and placeholder file of a scale, made once
+    data_file = os.path.join(work_dir, 'pcfg_' + scale + '.txt')
+    placeholder_file = os.path.join(work_dir, 'pcfg_' + scale + '_placeholders.txt')
+    if not os.path.exists(data_file) or not os.path.exists(placeholder_file):
+        lines = shipped_lines(scale)
+        nr_generated = 0
+        if SCALES[scale] is not None and len(lines) < SCALES[scale]:
+            t = markov_tree()
+            nr_generated = SCALES[scale] - len(lines)
+            for i in range(nr_generated):
+                line = sample_line(t, random_probs=False)
+                if line is not None:
+                    lines.append(line)
+        print('Prepared ' + scale + ': ' + str(len(lines) - nr_generated) + ' shipped and ' + str(nr_generated) + ' generated samples')
+        with open(placeholder_file, 'w') as f:
+            f.writelines(placeholder_line(line) for line in lines)
+        with open(data_file, 'w') as f:
+            f.writelines(lines)
+    with open(data_file, 'r') as f:
+        nr_samples = sum(1 for line in f)
+    return({'scale' : scale, 'data_file' : data_file, 'placeholder_file' : placeholder_file,
+            'nr_samples' : nr_samples, 'work_dir' : work_dir})
+
+def first_sources(data, bracketed=True):
+    with open(data['data_file'], 'r') as f:
+        sources = [line.split('\t')[0] for line in itertools.islice(f, MAX_PREPARED)]
+    if not bracketed:
+        return([source.replace('( ', '').replace(' )', '') for source in sources])
+    return([source.split() for source in sources])
+
+def cycle(items, nr_samples):
+    return(itertools.islice(itertools.cycle(items), nr_samples))
+
+# Each benchmark is a pair of functions: prepare(data) gives a state, run(state, data)
+# processes data['nr_samples'] samples. Only run is timed and measured
+
+def prepare_tree(data):
+    return(markov_tree())
+
+def prepare_trees(data):
+    t = markov_tree()
+    return((t, [t.build() for i in range(min(data['nr_samples'], MAX_PREPARED))]))
+
+def run_build(t, data):
+    for i in range(data['nr_samples']):
+        t.build()
+
+def run_write(state, data):
+    t, trees = state
+    for tree in cycle(trees, data['nr_samples']):
+        t.write(tree)
+
+def run_evaluate_tree(state, data):
+    t, trees = state
+    for tree in cycle(trees, data['nr_samples']):
+        t.evaluate_tree(tree)
+
+def run_generate_data(t, data):
+    generate_data(t, data['nr_samples'], os.path.join(data['work_dir'], 'generated'), random_probs=False)
+
+def prepare_inputs(data):
+    return(first_sources(data))
+
+def run_interpret(inputs, data):
+    for input in cycle(inputs, data['nr_samples']):
+        interpret(input)
+
+def run_get_substructures(inputs, data):
+    for input in cycle(inputs, data['nr_samples']):
+        get_substructures(input)
+
+def prepare_plain_sources(data):
+    return(first_sources(data, bracketed=False))
+
+def run_place_brackets(sources, data):
+    for source in cycle(sources, data['nr_samples']):
+        place_brackets(source)
+
+def prepare_naturalizer(data):
+    # Statistics are part of the work, so start without a sidecar file
+    if os.path.exists(tree_stats.sidecar_file(data['placeholder_file'])):
+        os.remove(tree_stats.sidecar_file(data['placeholder_file']))
+    t = markov_tree()
+    return(DataNaturalization(t.alphabet, t.unary_functions, t.binary_functions))
+
+def run_force_dist_on_data(naturalizer, data):
+    naturalizer.force_dist_on_data(None, data['placeholder_file'], 1, 1)
+
+def run_finalize(naturalizer, data):
+    naturalizer.finalize(data['placeholder_file'], seed=0)
+
+BENCHMARKS = {'build' : (prepare_tree, run_build),
+              'write' : (prepare_trees, run_write),
+              'evaluate_tree' : (prepare_trees, run_evaluate_tree),
+              'generate_data' : (prepare_tree, run_generate_data),
+              'interpret' : (prepare_inputs, run_interpret),
+              'get_substructures' : (prepare_inputs, run_get_substructures),
+              'place_brackets' : (prepare_plain_sources, run_place_brackets),
+              'force_dist_on_data' : (prepare_naturalizer, run_force_dist_on_data),
+              'finalize' : (prepare_naturalizer, run_finalize)}
+
+def measure(name, data, repeat=1, memory=True):
+    prepare, run = BENCHMARKS[name]
+    seconds = None
+    # Naturalization prints its progress
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            state = prepare(data)
+            start = time.perf_counter()
+            run(state, data)
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+        peak = None
+        if memory:
+            state = prepare(data)
+            tracemalloc.start()
+            run(state, data)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        state = None
+
+    return({'samples' : data['nr_samples'],
+            'seconds' : seconds,
+            'samples_per_sec' : data['nr_samples'] / seconds if seconds else float('inf'),
+            'peak_mb' : None if peak is None else peak / 2 ** 20})
+
+def import_time(module, repeat=5):
+    # Best cumulative import time of module in a fresh interpreter, in seconds, and the
+    # heavy modules it loads
+    code = 'import sys, {0}; print(" ".join(m for m in {1} if m in sys.modules))'.format(module, HEAVY_MODULES)
+    best = None
+    for i in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            # Top level imports are indented by one space
+            if len(fields) == 3 and fields[2] == ' ' + module:
+                seconds = int(fields[1]) / 1e6
+                best = seconds if best is None else min(best, seconds)
+    return(best, process.stdout.split())
+
+def compare(results, baseline, tolerance):
+    # Regressions against a baseline: throughput or memory worse than the tolerance allows
+    regressions = []
+    for scale, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            if result['samples_per_sec'] < base['samples_per_sec'] * (1 - tolerance):
+                regressions.append((scale, name, 'samples/sec', base['samples_per_sec'], result['samples_per_sec']))
+            if result['peak_mb'] is not None and base.get('peak_mb') and result['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+                regressions.append((scale, name, 'peak MB', base['peak_mb'], result['peak_mb']))
+    return(regressions)
+
+def print_result(scale, name, result, base=None):
+    line = '{:<6} {:<20} {:>9} samples {:>9.3f}s {:>12.0f} samples/sec'.format(scale, name, result['samples'], result['seconds'], result['samples_per_sec'])
+    if result['peak_mb'] is not None:
+        line += ' {:>9.1f} MB peak'.format(result['peak_mb'])
+    if base is not None:
+        line += '  ({:.2f}x baseline speed)'.format(result['samples_per_sec'] / base['samples_per_sec'])
+    print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=str, nargs='+', help='Scales to run at', choices=list(SCALES), default=list(SCALES))
+    parser.add_argument('--benchmarks', type=str, nargs='+', help='Benchmarks to run (default: all)', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, help='Report the best time of this many runs', default=3)
+    parser.add_argument('--no_memory', action='store_true', help='Do not measure peak memory (saves one run per benchmark)')
+    parser.add_argument('--work_dir', type=str, help='Directory for benchmark data and outputs', default='benchmark_data')
+    parser.add_argument('--save', type=str, help='Save the results as a baseline JSON file')
+    parser.add_argument('--baseline', type=str, help='Baseline JSON file to compare against')
+    parser.add_argument('--import_budget', type=float, help='Seconds importing generate may take', default=0.1)
+    parser.add_argument('--no_import_check', action='store_true', help='Do not check the import time of generate')
+    parser.add_argument('--tolerance', type=float, help='Fraction of slowdown or memory growth allowed against the baseline', default=0.2)
+    opt = parser.parse_args()
+
+    os.makedirs(opt.work_dir, exist_ok=True)
+    baseline = {}
+    if opt.baseline:
+        with open(opt.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+
+    import_failures = []
+    imports = None
+    if not opt.no_import_check:
+        seconds, heavy = import_time('generate')
+        imports = {'generate' : {'seconds' : seconds, 'heavy_modules' : heavy}}
+        print('import generate: {:.1f} ms (budget {:.1f} ms){}'.format(seconds * 1000, opt.import_budget * 1000, ', loads ' + ', '.join(heavy) if heavy else ''))
+        if seconds > opt.import_budget:
+            import_failures.append('import generate takes {:.1f} ms, over the budget of {:.1f} ms'.format(seconds * 1000, opt.import_budget * 1000))
+        if heavy:
+            import_failures.append('import generate loads ' + ', '.join(heavy))
+
+    results = {}
+    for scale in opt.scales:
+        data = prepare_scale(scale, opt.work_dir)
+        results[scale] = {}
+        for name in opt.benchmarks:
+            result = measure(name, data, opt.repeat, not opt.no_memory)
+            results[scale][name] = result
+            print_result(scale, name, result, baseline.get(scale, {}).get(name))
+
+    if opt.save:
+        with open(opt.save, 'w') as f:
+            json.dump({'python' : sys.version, 'platform' : platform.platform(), 'imports' : imports, 'results' : results}, f, indent=2)
+        print('Saved results to ' + opt.save)
+
+    for failure in import_failures:
+        print('Regression: ' + failure)
+    regressions = []
+    if opt.baseline:
+        regressions = compare(results, baseline, opt.tolerance)
+        for scale, name, measure_name, base_value, value in regressions:
+            print('Regression: {} {} {} {:.1f} -> {:.1f}'.format(scale, name, measure_name, base_value, value))
+        if not regressions:
+            print('No regressions beyond ' + '{:.0%}'.format(opt.tolerance) + ' against ' + opt.baseline)
+    if regressions or import_failures:
+        sys.exit(1)
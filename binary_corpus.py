@@ -0,0 +1,171 @@
+"""
+Binary token corpus for PCFG SET data, read through memory maps.
+
+A text file with one sequence per line (random_split/*.src, *.tgt, or data files with
+source and target separated by a tab) is encoded into a fixed vocabulary: brackets,
+comma, tab, the placeholder X, the function names of the task and its alphabet letters
+with their numeric suffixes. The vocabulary does not depend on the data, so corpora
+encoded with the same task and alphabet ratio share their token ids. A corpus is three
+files next to each other:
+
+    <prefix>.bin    token ids of all lines, int16 (int32 for vocabularies of 2 ** 15 or more)
+    <prefix>.idx    int64 offsets into the token ids, one more than there are lines
+    <prefix>.vocab  the vocabulary, one token per line
+
+Sample i is tokens offsets[i] up to offsets[i + 1]. Decoding gives back the text file.
+
+"""
+
+import argparse
+import os
+import numpy as np
+
+import tasks
+
+SPECIAL_TOKENS = ['(', ')', ',', '\t', 'X']
+
+def build_vocabulary(task, alphabet_ratio):
+    # Same letters as generate.py makes for this alphabet ratio, also without suffix
+    tokens = SPECIAL_TOKENS + [func.__name__ for func in task.unary_functions + task.binary_functions]
+    tokens += list(task.alphabet)
+    tokens += [letter + str(i) for letter in task.alphabet for i in range(1, alphabet_ratio + 1)]
+    vocabulary = []
+    seen = set()
+    for token in tokens:
+        if not token in seen:
+            seen.add(token)
+            vocabulary.append(token)
+    return(vocabulary)
+
+def token_dtype(vocabulary):
+    return(np.int16 if len(vocabulary) < 2 ** 15 else np.int32)
+
+def corpus_files(prefix):
+    return(prefix + '.bin', prefix + '.idx', prefix + '.vocab')
+
+def line_tokens(line):
+    # Tokens of a line, with the tab between source and target as a token of its own
+    tokens = []
+    for field_idx, field in enumerate(line.split('\t')):
+        if field_idx:
+            tokens.append('\t')
+        if field:
+            tokens += field.split(' ')
+    return(tokens)
+
+def tokens_line(tokens):
+    fields = [[]]
+    for token in tokens:
+        if token == '\t':
+            fields.append([])
+        else:
+            fields[-1].append(token)
+    return('\t'.join(' '.join(field) for field in fields))
+
+def encode_file(text_file, prefix, vocabulary, chunk_lines=100000):
+    """
+    Encode a text file, streaming it in chunks of lines. Raises ValueError for tokens
+    outside the vocabulary, and for lines that would not decode to the same text.
+    Returns the number of lines.
+    """
+    token_ids = {token : idx for idx, token in enumerate(vocabulary)}
+    dtype = token_dtype(vocabulary)
+    bin_file, idx_file, vocab_file = corpus_files(prefix)
+
+    nr_lines = 0
+    offset = 0
+    with open(text_file, 'r') as f, open(bin_file, 'wb') as fbin, open(idx_file, 'wb') as fidx:
+        np.zeros(1, dtype=np.int64).tofile(fidx)
+        ids, ends = [], []
+        for line in f:
+            line = line.rstrip('\n')
+            tokens = line_tokens(line)
+            if tokens_line(tokens) != line:
+                raise ValueError('Line ' + str(nr_lines + 1) + ' of ' + text_file + ' is not single space separated')
+            try:
+                ids += [token_ids[token] for token in tokens]
+            except KeyError as e:
+                raise ValueError('Token ' + repr(e.args[0]) + ' on line ' + str(nr_lines + 1) + ' of ' + text_file + ' is not in the vocabulary (alphabet ratio too small?)')
+            ends.append(offset + len(ids))
+            nr_lines += 1
+            if len(ends) == chunk_lines:
+                np.array(ids, dtype=dtype).tofile(fbin)
+                np.array(ends, dtype=np.int64).tofile(fidx)
+                offset = ends[-1]
+                ids, ends = [], []
+        np.array(ids, dtype=dtype).tofile(fbin)
+        np.array(ends, dtype=np.int64).tofile(fidx)
+
+    with open(vocab_file, 'w') as f:
+        # The tab is stored escaped, so every token is on a line of its own
+        f.write(''.join(token.replace('\t', '\\t') + '\n' for token in vocabulary))
+    return(nr_lines)
+
+class BinaryCorpus():
+    """
+    Random access to the samples of an encoded corpus. Token ids are only read from
+    disk when a sample is accessed, so opening a corpus of any size is immediate.
+    """
+    def __init__(self, prefix):
+        bin_file, idx_file, vocab_file = corpus_files(prefix)
+        with open(vocab_file, 'r') as f:
+            self.vocabulary = [line.rstrip('\n').replace('\\t', '\t') for line in f]
+        self.token_ids = {token : idx for idx, token in enumerate(self.vocabulary)}
+        self.offsets = np.memmap(idx_file, dtype=np.int64, mode='r')
+        if os.path.getsize(bin_file) == 0:
+            self.data = np.zeros(0, dtype=token_dtype(self.vocabulary))
+        else:
+            self.data = np.memmap(bin_file, dtype=token_dtype(self.vocabulary), mode='r')
+        if len(self.data) != self.offsets[-1]:
+            raise ValueError('Offset index does not match ' + bin_file)
+
+    def __len__(self):
+        return(len(self.offsets) - 1)
+
+    def __getitem__(self, idx):
+        # Token ids of sample idx, as a view on the memory map
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('Sample index out of range')
+        return(self.data[self.offsets[idx] : self.offsets[idx + 1]])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield(self[idx])
+
+    def tokens(self, idx):
+        vocabulary = self.vocabulary
+        return([vocabulary[token_id] for token_id in self[idx].tolist()])
+
+    def line(self, idx):
+        return(tokens_line(self.tokens(idx)))
+
+def decode_file(prefix, text_file):
+    corpus = BinaryCorpus(prefix)
+    with open(text_file, 'w') as f:
+        for idx in range(len(corpus)):
+            f.write(corpus.line(idx) + '\n')
+    return(len(corpus))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--encode', type=str, nargs='+', help='Text files to encode, each to <file>.bin/.idx/.vocab')
+    parser.add_argument('--decode', type=str, nargs='+', help='Corpus prefixes to decode, each to <prefix>.decoded')
+    parser.add_argument('--task', type=str, help='The PCFG SET task whose functions and alphabet make the vocabulary', default='default')
+    parser.add_argument('--alphabet_ratio', type=int, help='Alphabet ratio the data was generated with', default=20)
+    opt = parser.parse_args()
+
+    if not opt.encode and not opt.decode:
+        parser.error('Files to encode or decode required.')
+
+    if opt.encode:
+        vocabulary = build_vocabulary(getattr(tasks, opt.task), opt.alphabet_ratio)
+        for text_file in opt.encode:
+            nr_lines = encode_file(text_file, text_file, vocabulary)
+            print('Encoded ' + str(nr_lines) + ' lines of ' + text_file + ' into ' + text_file + '.bin')
+
+    if opt.decode:
+        for prefix in opt.decode:
+            nr_lines = decode_file(prefix, prefix + '.decoded')
+            print('Decoded ' + str(nr_lines) + ' lines into ' + prefix + '.decoded')
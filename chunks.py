@@ -0,0 +1,26 @@
+"""
+Streaming files in chunks of lines, and mapping a function over the chunks in order,
+in a process pool or in this process. Shared by the modules that process whole data
+files in parallel.
+
+"""
+
+import collections
+import itertools
+
+def map_chunks(func, jobs, pool=None, processes=1):
+    # Results of func for every argument tuple in jobs, in order. With a pool, at most
+    # twice as many jobs as processes are in flight, so memory stays bounded
+    pending = collections.deque()
+    for args in jobs:
+        if pool is None:
+            yield(func(*args))
+            continue
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= 2 * processes:
+            yield(pending.popleft().get())
+    while pending:
+        yield(pending.popleft().get())
+
+def read_chunks(f, chunk_size):
+    return(iter(lambda: list(itertools.islice(f, chunk_size)), []))
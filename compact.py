@@ -0,0 +1,168 @@
+"""
+Compact storage for large numbers of PCFG SET trees.
+
+A TreeBatch keeps every tree in prefix order as one node per function call or string
+argument: a function id (>= 0), or the negated length of a string argument (< 0), the
+same encoding as the tree shapes in gather.py. The letters of all string arguments go
+into one shared pool of letter ids. Trees can be written and evaluated straight from
+these arrays, without rebuilding nested lists. MarkovTree.generate_data(compact=True)
+samples trees straight into a batch, so no nested lists are built at all.
+
+"""
+
+from array import array
+
+class TreeBatch():
+    __slots__ = ('pcfg_tree', 'vocabulary', 'letter_ids', 'nodes', 'node_ends', 'letters', 'letter_ends')
+
+    def __init__(self, pcfg_tree):
+        self.pcfg_tree = pcfg_tree
+        # Placeholder arguments consist of X only
+        self.vocabulary = list(pcfg_tree.alphabet) + ['X']
+        self.letter_ids = {letter : idx for idx, letter in enumerate(self.vocabulary)}
+
+        # Typecodes are as small as PCFG SET allows; an OverflowError is raised rather
+        # than storing a function id or string length above 127, or more than 2 ** 32
+        # nodes or letters in one batch
+        self.nodes = array('b')
+        self.node_ends = array('I')
+        self.letters = array('H' if len(self.vocabulary) < 2 ** 16 else 'I')
+        self.letter_ends = array('I')
+
+    def __len__(self):
+        return(len(self.node_ends))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield(self.tree(idx))
+
+    def nbytes(self):
+        return(sum(len(a) * a.itemsize for a in [self.nodes, self.node_ends, self.letters, self.letter_ends]))
+
+    def append(self, tree):
+        # Flatten a nested list tree from MarkovTree.build in prefix order
+        function_ids = self.pcfg_tree.function_ids
+        is_unary = self.pcfg_tree.function_is_unary
+        letter_ids = self.letter_ids
+        stack = [tree]
+        while stack:
+            item = stack.pop()
+            func_id = function_ids.get(item[0])
+            if func_id is None:
+                self.nodes.append(-len(item))
+                self.letters.extend([letter_ids[letter] for letter in item])
+            else:
+                self.nodes.append(func_id)
+                if is_unary[func_id]:
+                    stack.append(item[1])
+                else:
+                    stack += [item[2], item[1]]
+        self.node_ends.append(len(self.nodes))
+        self.letter_ends.append(len(self.letters))
+
+    def append_function(self, func_id):
+        # Nodes of a tree being sampled straight into the batch, see MarkovTree.build
+        self.nodes.append(func_id)
+
+    def append_string(self, letters):
+        self.nodes.append(-len(letters))
+        self.letters.extend([self.letter_ids[letter] for letter in letters])
+
+    def end_tree(self):
+        self.node_ends.append(len(self.nodes))
+        self.letter_ends.append(len(self.letters))
+
+    def discard_tree(self):
+        # Drop the nodes of a tree that was not finished
+        node_start = self.node_ends[-1] if len(self) else 0
+        letter_start = self.letter_ends[-1] if len(self) else 0
+        del self.nodes[node_start:]
+        del self.letters[letter_start:]
+
+    def spans(self, idx):
+        node_start = self.node_ends[idx - 1] if idx > 0 else 0
+        letter_start = self.letter_ends[idx - 1] if idx > 0 else 0
+        return(node_start, self.node_ends[idx], letter_start, self.letter_ends[idx])
+
+    def shape(self, idx):
+        node_start, node_end = self.spans(idx)[:2]
+        return(tuple(self.nodes[node_start : node_end]))
+
+    def strings(self, idx):
+        # String arguments of tree idx, left to right
+        node_start, node_end, letter_start, letter_end = self.spans(idx)
+        vocabulary = self.vocabulary
+        letters = [vocabulary[letter_id] for letter_id in self.letters[letter_start : letter_end]]
+        strings = []
+        position = 0
+        for node in self.nodes[node_start : node_end]:
+            if node < 0:
+                strings.append(letters[position : position - node])
+                position -= node
+        return(strings)
+
+    def tree(self, idx):
+        # Rebuild the nested list tree, evaluating the prefix order backwards
+        functions = self.pcfg_tree.all_functions
+        is_unary = self.pcfg_tree.function_is_unary
+        node_start, node_end = self.spans(idx)[:2]
+        strings = self.strings(idx)
+        values = []
+        for node in reversed(self.nodes[node_start : node_end]):
+            if node < 0:
+                values.append(strings.pop())
+            elif is_unary[node]:
+                values[-1] = [functions[node], values[-1]]
+            else:
+                arg1 = values.pop()
+                values[-1] = [functions[node], arg1, values[-1]]
+        return(values[0])
+
+    def write(self, idx):
+        # Source string of tree idx, closing each function once all its arguments are written
+        names = self.pcfg_tree.function_names
+        is_unary = self.pcfg_tree.function_is_unary
+        brackets = not self.pcfg_tree.omit_brackets
+        node_start, node_end = self.spans(idx)[:2]
+        strings = self.strings(idx)
+        strings.reverse()
+
+        pieces = []
+        open_args = []
+        for node in self.nodes[node_start : node_end]:
+            if node >= 0:
+                pieces.append(names[node])
+                if brackets:
+                    pieces.append('(')
+                open_args.append(1 if is_unary[node] else 2)
+                continue
+
+            pieces.append(' '.join(strings.pop()))
+            while open_args:
+                open_args[-1] -= 1
+                if open_args[-1]:
+                    pieces.append(',')
+                    break
+                open_args.pop()
+                if brackets:
+                    pieces.append(')')
+        return(' '.join(pieces))
+
+    def evaluate(self, idx):
+        functions = self.pcfg_tree.all_functions
+        is_unary = self.pcfg_tree.function_is_unary
+        node_start, node_end = self.spans(idx)[:2]
+        strings = self.strings(idx)
+        values = []
+        for node in reversed(self.nodes[node_start : node_end]):
+            if node < 0:
+                values.append(strings.pop())
+            elif is_unary[node]:
+                values[-1] = functions[node](values[-1])
+            else:
+                arg1 = values.pop()
+                values[-1] = functions[node](arg1, values[-1])
+        return(values[0])
+
+    def write_and_evaluate(self, idx):
+        return(self.write(idx), self.evaluate(idx))
@@ -0,0 +1,147 @@
+"""
+Evaluation sets for the localism and substitutivity tests of PCFG SET.
+
+Every sample of a data file is parsed once, and every function call in it (every
+subtree) is evaluated once, innermost first. From those shared results come:
+
+    subtrees        every subtree of the sample with its output, the intermediate targets
+    localism        the sample with one subtree replaced by its output, for every subtree
+                    below the top call; the target is that of the sample
+    substitutivity  the sample with all calls of one function renamed to its synonym
+                    (name + '_syn'), for every function in the sample; the target is that
+                    of the sample
+
+Lines are source \t target \t index of the sample in the data file. Samples need
+brackets, as for interpret; lines without a complete function call are skipped.
+Files are processed in chunks, in parallel with several workers, and the output is
+the same for any number of workers.
+
+"""
+
+import argparse
+import multiprocessing
+import os
+
+from interpret_set import FUNC_DICT
+from chunks import map_chunks, read_chunks
+
+KINDS = ['subtrees', 'localism', 'substitutivity']
+
+def evaluate_subtrees(tokens):
+    """
+    Parse tokens in one pass and evaluate every call once. Returns the calls in the
+    order of the sample as [function name, start, end, output] with tokens[start:end]
+    the call, or None if tokens are not a single complete call.
+    """
+    if not tokens or not tokens[0] in FUNC_DICT:
+        return(None)
+    nodes = []
+    # Open calls: node index, finished arguments and the argument being read
+    calls = []
+    for idx, token in enumerate(tokens):
+        if token in FUNC_DICT:
+            nodes.append([token, idx, None, None])
+            calls.append([len(nodes) - 1, [], []])
+        elif token == '(':
+            continue
+        elif token == ',' or token == ')':
+            if not calls:
+                return(None)
+            call = calls[-1]
+            call[1].append(call[2])
+            if token == ',':
+                call[2] = []
+                continue
+            node_idx, args, arg = calls.pop()
+            node = nodes[node_idx]
+            node[2] = idx + 1
+            node[3] = FUNC_DICT[node[0]](*args)
+            if not calls:
+                # The top call has to span the whole sample
+                return(nodes if idx + 1 == len(tokens) else None)
+            calls[-1][2] = node[3]
+        elif calls:
+            calls[-1][2].append(token)
+    return(None)
+
+def build_chunk(lines, first_idx, kinds, synonym_functions, synonym_suffix):
+    # Lines of each kind for a chunk of data lines, and the number of lines skipped
+    results = {kind : [] for kind in kinds}
+    nr_skipped = 0
+    for line_idx, line in enumerate(lines):
+        tokens = line.split('\t')[0].split()
+        nodes = evaluate_subtrees(tokens)
+        if nodes is None:
+            nr_skipped += 1
+            continue
+        sample_idx = str(first_idx + line_idx)
+        target = ' '.join(nodes[0][3])
+
+        if 'subtrees' in results:
+            for func_name, start, end, output in nodes:
+                results['subtrees'].append(' '.join(tokens[start:end]) + '\t' + ' '.join(output) + '\t' + sample_idx + '\n')
+        if 'localism' in results:
+            for func_name, start, end, output in nodes[1:]:
+                source = tokens[:start] + output + tokens[end:]
+                results['localism'].append(' '.join(source) + '\t' + target + '\t' + sample_idx + '\n')
+        if 'substitutivity' in results:
+            for func_name in dict.fromkeys(node[0] for node in nodes):
+                if synonym_functions is None or func_name in synonym_functions:
+                    source = [token + synonym_suffix if token == func_name else token for token in tokens]
+                    results['substitutivity'].append(' '.join(source) + '\t' + target + '\t' + sample_idx + '\n')
+    return(results, nr_skipped)
+
+def build_evaluation_sets(data_file, output_root, kinds=KINDS, synonym_functions=None, synonym_suffix='_syn',
+                          processes=1, chunk_size=10000):
+    """
+    Write output_root + '_' + kind + '.txt' for every kind, streaming the data file.
+    Returns the output files, the number of lines written per kind and the number of
+    data lines skipped.
+    """
+    output_files = {kind : output_root + '_' + kind + '.txt' for kind in kinds}
+    counts = {kind : 0 for kind in kinds}
+    nr_skipped = 0
+    fouts = {}
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        for kind, output_file in output_files.items():
+            fouts[kind] = open(output_file, 'w')
+        with open(data_file, 'r') as f:
+            jobs = ((lines, chunk_idx * chunk_size, kinds, synonym_functions, synonym_suffix)
+                    for chunk_idx, lines in enumerate(read_chunks(f, chunk_size)))
+            for results, chunk_skipped in map_chunks(build_chunk, jobs, pool, processes):
+                for kind, lines in results.items():
+                    fouts[kind].write(''.join(lines))
+                    counts[kind] += len(lines)
+                nr_skipped += chunk_skipped
+    finally:
+        if pool is not None:
+            pool.terminate()
+        for fout in fouts.values():
+            fout.close()
+    return(output_files, counts, nr_skipped)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_file', type=str, help='Data file (with brackets) to build evaluation sets of', required=True)
+    parser.add_argument('--output_root', type=str, help='Output path root (default: data file without extension)')
+    parser.add_argument('--kinds', type=str, nargs='+', choices=KINDS, help='Evaluation sets to build', default=KINDS)
+    parser.add_argument('--synonym_functions', type=str, nargs='+', help='Functions that have a synonym (default: all)')
+    parser.add_argument('--synonym_suffix', type=str, help='Suffix that makes the synonym of a function name', default='_syn')
+    parser.add_argument('--workers', type=int, help='Number of processes', default=1)
+    parser.add_argument('--chunk_size', type=int, help='Data lines per chunk', default=10000)
+    opt = parser.parse_args()
+
+    if opt.synonym_functions:
+        unknown = [name for name in opt.synonym_functions if not name in FUNC_DICT]
+        if unknown:
+            parser.error('Unknown functions: ' + ', '.join(unknown))
+
+    output_root = opt.output_root or os.path.splitext(opt.data_file)[0]
+    output_files, counts, nr_skipped = build_evaluation_sets(opt.data_file, output_root, opt.kinds,
+                                                             opt.synonym_functions, opt.synonym_suffix,
+                                                             opt.workers, opt.chunk_size)
+    for kind, output_file in output_files.items():
+        print(kind + ': ' + str(counts[kind]) + ' lines in ' + output_file)
+    if nr_skipped:
+        print('Skipped ' + str(nr_skipped) + ' lines without a complete function call')
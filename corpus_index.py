@@ -0,0 +1,257 @@
+"""
+Index of a PCFG SET data file, to extract productivity and systematicity splits
+without reparsing the data for every query.
+
+Building the index reads the file once (in parallel chunks) and records for every
+sample its byte offset, its depth and length (through tree_stats, given the arities of
+the functions of the task), how often each function of the task occurs in it, and
+which functions occur inside which: one bit per (outer, inner) pair of functions for
+every function call inside the argument of another. Sources are parsed by the arity of
+the functions, so files with and without brackets are indexed the same. The index is
+kept next to the data (<file>.index.npz), and rebuilt when the data file changes.
+
+Queries are clauses joined by 'and', each on the arrays of the index:
+
+    depth >= 5 and length < 20
+    contains swap_first_last inside repeat and not contains append
+
+Selected samples are read straight from their byte offsets.
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import numpy as np
+
+import tasks
+import tree_stats
+from chunks import map_chunks, read_chunks
+
+MASK_64 = (1 << 64) - 1
+
+# Indexes of another version are rebuilt; version 2 reads the depths of sources without
+# brackets by the arities of the task of the index
+INDEX_VERSION = 2
+
+COMPARISONS = {'<' : np.less, '<=' : np.less_equal, '>' : np.greater, '>=' : np.greater_equal,
+               '==' : np.equal, '!=' : np.not_equal}
+
+def index_file(file):
+    return(file + '.index.npz')
+
+def index_chunk(lines, function_ids, is_unary, arities):
+    """
+    Index arrays for a chunk of lines (bytes): line sizes in bytes, depths, lengths,
+    function counts and (outer, inner) pair bits, the bits of a sample as 64-bit words.
+    """
+    nr_functions = len(is_unary)
+    nr_words = (nr_functions * nr_functions + 63) // 64
+    sizes = np.array([len(line) for line in lines], dtype=np.int64)
+    depths, lengths = tree_stats.sources_statistics([line.split(b'\t', 1)[0].rstrip(b'\n') for line in lines], arities)
+    function_counts = np.zeros((len(lines), nr_functions), dtype=np.uint16)
+    pair_words = np.zeros((len(lines), nr_words), dtype=np.uint64)
+
+    for line_idx, line in enumerate(lines):
+        counts = [0] * nr_functions
+        pairs = 0
+        # Open function calls, with the number of arguments each still needs
+        open_ids = []
+        open_args = []
+        in_string = False
+        for token in line.split(b'\t', 1)[0].decode('utf-8').split():
+            func_id = function_ids.get(token)
+            if func_id is None:
+                # A string argument is a run of string tokens
+                in_string = True
+                continue
+            if in_string:
+                # The string argument ends here, and with it every call it completes
+                in_string = False
+                while open_args:
+                    open_args[-1] -= 1
+                    if open_args[-1]:
+                        break
+                    open_args.pop()
+                    open_ids.pop()
+            if func_id >= 0:
+                counts[func_id] += 1
+                for outer_id in set(open_ids):
+                    pairs |= 1 << (outer_id * nr_functions + func_id)
+                open_ids.append(func_id)
+                open_args.append(1 if is_unary[func_id] else 2)
+        function_counts[line_idx] = counts
+        for word_idx in range(nr_words):
+            pair_words[line_idx, word_idx] = (pairs >> (64 * word_idx)) & MASK_64
+    return(sizes, depths, lengths, function_counts, pair_words)
+
+def build_index(file, task=tasks.default, processes=1, chunk_size=100000):
+    # Index arrays of a whole data file, plus the signature of the file they belong to
+    function_names = [func.__name__ for func in task.unary_functions + task.binary_functions]
+    is_unary = [True for func in task.unary_functions] + [False for func in task.binary_functions]
+    function_ids = {name : idx for idx, name in enumerate(function_names)}
+    for token in ['(', ')', ',']:
+        function_ids[token] = -1
+
+    arities = tree_stats.function_arities(task)
+    signature = tree_stats.file_signature(file)
+    results = []
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        with open(file, 'rb') as f:
+            jobs = ((lines, function_ids, is_unary, arities) for lines in read_chunks(f, chunk_size))
+            for result in map_chunks(index_chunk, jobs, pool, processes):
+                results.append(result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    nr_words = (len(function_names) ** 2 + 63) // 64
+    if results:
+        sizes, depths, lengths, function_counts, pair_words = [np.concatenate(arrays) for arrays in zip(*results)]
+    else:
+        sizes, depths, lengths = [np.zeros(0, dtype=np.int64) for i in range(3)]
+        function_counts = np.zeros((0, len(function_names)), dtype=np.uint16)
+        pair_words = np.zeros((0, nr_words), dtype=np.uint64)
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    return({'version' : INDEX_VERSION,
+            'signature' : signature,
+            'function_names' : np.array(function_names),
+            'offsets' : offsets,
+            'depths' : depths,
+            'lengths' : lengths,
+            'function_counts' : function_counts,
+            'pair_words' : pair_words})
+
+class CorpusIndex():
+    """
+    Index of a data file, loaded from its .index.npz if that is up to date, of this
+    version and of the same functions, built (and saved) otherwise.
+    """
+    def __init__(self, file, task=tasks.default, processes=1, use_cache=True):
+        self.file = file
+        function_names = [func.__name__ for func in task.unary_functions + task.binary_functions]
+        arrays = None
+        if use_cache and os.path.exists(index_file(file)):
+            try:
+                with np.load(index_file(file)) as stored:
+                    if (stored['version'] == INDEX_VERSION and
+                        np.array_equal(stored['signature'], tree_stats.file_signature(file)) and
+                        stored['function_names'].tolist() == function_names):
+                        arrays = {name : stored[name] for name in stored.files}
+            except (OSError, KeyError, ValueError):
+                pass
+        if arrays is None:
+            arrays = build_index(file, task, processes)
+            if use_cache:
+                try:
+                    # Write under a temporary name first, so readers never see half an index
+                    temporary = index_file(file) + '.tmp.npz'
+                    np.savez(temporary, **arrays)
+                    os.replace(temporary, index_file(file))
+                except OSError:
+                    pass
+
+        self.function_names = arrays['function_names'].tolist()
+        self.function_ids = {name : idx for idx, name in enumerate(self.function_names)}
+        self.offsets = arrays['offsets']
+        self.depths = arrays['depths']
+        self.lengths = arrays['lengths']
+        self.function_counts = arrays['function_counts']
+        self.pair_words = arrays['pair_words']
+
+    def __len__(self):
+        return(len(self.depths))
+
+    def function_id(self, name):
+        if not name in self.function_ids:
+            raise ValueError('Unknown function ' + repr(name))
+        return(self.function_ids[name])
+
+    def contains(self, name):
+        return(self.function_counts[:, self.function_id(name)] > 0)
+
+    def contains_inside(self, inner, outer):
+        # Samples with a call of inner somewhere in the argument of a call of outer
+        bit = self.function_id(outer) * len(self.function_names) + self.function_id(inner)
+        return((self.pair_words[:, bit // 64] >> np.uint64(bit % 64)) & np.uint64(1) == 1)
+
+    def clause_mask(self, clause):
+        words = clause.split()
+        negate = bool(words) and words[0] == 'not'
+        if negate:
+            words = words[1:]
+        if len(words) == 3 and words[0] in ['depth', 'length'] and words[1] in COMPARISONS and re.fullmatch(r'-?\d+', words[2]):
+            mask = COMPARISONS[words[1]](self.depths if words[0] == 'depth' else self.lengths, int(words[2]))
+        elif len(words) == 2 and words[0] == 'contains':
+            mask = self.contains(words[1])
+        elif len(words) == 4 and words[0] == 'contains' and words[2] == 'inside':
+            mask = self.contains_inside(words[1], words[3])
+        else:
+            raise ValueError('Cannot parse query clause ' + repr(clause))
+        return(~mask if negate else mask)
+
+    def query(self, query):
+        # Ids of the samples that satisfy all clauses of the query, in file order
+        mask = np.ones(len(self), dtype=bool)
+        for clause in query.split(' and '):
+            mask &= self.clause_mask(clause.strip())
+        return(np.flatnonzero(mask))
+
+    def stratified_sample(self, ids, by='depth', nr_per_stratum=100, seed=None):
+        # At most nr_per_stratum random ids of every depth (or length) among ids
+        rng = np.random.default_rng(seed)
+        keys = (self.depths if by == 'depth' else self.lengths)[ids]
+        selected = []
+        for key in np.unique(keys):
+            stratum = ids[keys == key]
+            selected.append(rng.choice(stratum, min(nr_per_stratum, len(stratum)), replace=False))
+        if not selected:
+            return(np.zeros(0, dtype=np.int64))
+        return(np.sort(np.concatenate(selected)))
+
+    def lines(self, ids):
+        # Lines of the samples with these ids, read at their offsets
+        lines = []
+        with open(self.file, 'rb') as f:
+            for idx in ids:
+                f.seek(self.offsets[idx])
+                lines.append(f.read(self.offsets[idx + 1] - self.offsets[idx]).decode('utf-8'))
+        return(lines)
+
+    def write_samples(self, ids, output_file):
+        with open(self.file, 'rb') as fin, open(output_file, 'wb') as fout:
+            for idx in ids:
+                fin.seek(self.offsets[idx])
+                fout.write(fin.read(self.offsets[idx + 1] - self.offsets[idx]))
+        return(len(ids))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_file', type=str, help='Data file to index and query', required=True)
+    parser.add_argument('--task', type=str, help='The PCFG SET task of the data', default='default')
+    parser.add_argument('--workers', type=int, help='Number of processes to build the index with', default=1)
+    parser.add_argument('--query', type=str, help='Samples to select, e.g. "depth >= 5 and contains swap_first_last inside repeat"')
+    parser.add_argument('--stratify', type=str, choices=['depth', 'length'], help='Sample the selection per depth or length')
+    parser.add_argument('--nr_per_stratum', type=int, help='Samples per depth or length with --stratify', default=100)
+    parser.add_argument('--seed', type=int, help='Random seed of --stratify', default=None)
+    parser.add_argument('--output_file', type=str, help='Write the selected samples to this file')
+    parser.add_argument('--rest_file', type=str, help='Write all samples that were not selected to this file')
+    opt = parser.parse_args()
+
+    index = CorpusIndex(opt.data_file, getattr(tasks, opt.task), opt.workers)
+    print('Indexed ' + str(len(index)) + ' samples of ' + opt.data_file)
+
+    if opt.query or opt.stratify:
+        ids = index.query(opt.query) if opt.query else np.arange(len(index))
+        if opt.stratify:
+            ids = index.stratified_sample(ids, opt.stratify, opt.nr_per_stratum, opt.seed)
+        print('Selected ' + str(len(ids)) + ' samples')
+        if opt.output_file:
+            index.write_samples(ids, opt.output_file)
+            print('Selected samples written to ' + opt.output_file)
+        if opt.rest_file:
+            rest = np.setdiff1d(np.arange(len(index)), ids)
+            index.write_samples(rest, opt.rest_file)
+            print(str(len(rest)) + ' other samples written to ' + opt.rest_file)
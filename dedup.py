@@ -0,0 +1,180 @@
+"""
+Deduplication of PCFG SET data, and train/dev/test overlap reports.
+
+Sources are reduced to 64-bit fingerprints, kept in a hash index with flags for
+the splits they were seen in. The in-memory index is an open addressing table of
+fixed size, set by a memory budget; for corpora beyond that budget an on-disk
+SQLite index can be used instead. Files are streamed, never loaded as a whole.
+
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+from array import array
+
+from split_data import SPLITS
+
+class IndexFull(Exception):
+    pass
+
+def fingerprint(source):
+    return(int.from_bytes(hashlib.blake2b(source.encode('utf-8'), digest_size=8).digest(), 'big'))
+
+class FingerprintIndex():
+    """
+    Open addressing table of fingerprints with linear probing, plus a byte of flags
+    per fingerprint. Takes 9 bytes per slot and holds up to 3/4 of its slots.
+    """
+    def __init__(self, memory_budget=256 * 2 ** 20):
+        capacity = 1
+        while capacity * 2 * 9 <= memory_budget:
+            capacity *= 2
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.max_size = capacity * 3 // 4
+        self.size = 0
+        self.keys = array('Q', bytes(8 * capacity))
+        self.flags = array('B', bytes(capacity))
+
+    def __len__(self):
+        return(self.size)
+
+    def update(self, fp, flag=1):
+        # Add flag to fingerprint fp and return the flags it had before (0 if new).
+        # Slot key 0 marks an empty slot, so fingerprint 0 is stored as 1
+        fp = fp or 1
+        keys = self.keys
+        slot = fp & self.mask
+        while True:
+            key = keys[slot]
+            if key == fp:
+                previous = self.flags[slot]
+                self.flags[slot] = previous | flag
+                return(previous)
+            if key == 0:
+                break
+            slot = (slot + 1) & self.mask
+
+        if self.size >= self.max_size:
+            raise IndexFull('Fingerprint index is full at ' + str(self.size) + ' entries; raise the memory budget or use a disk index')
+        keys[slot] = fp
+        self.flags[slot] = flag
+        self.size += 1
+        return(0)
+
+    def close(self):
+        pass
+
+class DiskIndex():
+    """
+    Same interface, backed by a SQLite table, for corpora beyond the memory budget.
+    Starts empty, replacing an index left at path by an earlier run.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('DROP TABLE IF EXISTS fingerprints')
+        self.connection.execute('CREATE TABLE fingerprints (fp INTEGER PRIMARY KEY, flags INTEGER)')
+        self.size = 0
+        self.pending = 0
+
+    def __len__(self):
+        return(self.size)
+
+    def update(self, fp, flag=1):
+        # SQLite integers are signed
+        fp -= (fp >> 63) << 64
+        row = self.connection.execute('SELECT flags FROM fingerprints WHERE fp = ?', (fp,)).fetchone()
+        if row is None:
+            self.connection.execute('INSERT INTO fingerprints VALUES (?, ?)', (fp, flag))
+            self.size += 1
+            previous = 0
+        else:
+            previous = row[0]
+            if previous | flag != previous:
+                self.connection.execute('UPDATE fingerprints SET flags = ? WHERE fp = ?', (previous | flag, fp))
+
+        self.pending += 1
+        if self.pending == 100000:
+            self.connection.commit()
+            self.pending = 0
+        return(previous)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def make_index(memory_budget, disk_index=None):
+    if disk_index is not None:
+        return(DiskIndex(disk_index))
+    return(FingerprintIndex(memory_budget))
+
+def deduplicate(data_file, output_file, index):
+    # Keep the first occurrence of every source of a data file (source \t target lines)
+    nr_lines, nr_removed = 0, 0
+    with open(data_file, 'r') as fin, open(output_file, 'w') as fout:
+        for line in fin:
+            nr_lines += 1
+            if index.update(fingerprint(line.split('\t')[0].strip())):
+                nr_removed += 1
+            else:
+                fout.write(line)
+    return(nr_lines, nr_removed)
+
+def overlap_report(split_dir, index):
+    # Duplicates within each split of random_split/{train,dev,test}.src, and lines of
+    # each split whose source already occurs in an earlier split
+    report = {'lines' : {}, 'duplicates' : {}, 'overlap' : {}}
+    present = []
+    for split_idx, split in enumerate(SPLITS):
+        split_file = os.path.join(split_dir, split + '.src')
+        if not os.path.exists(split_file):
+            continue
+        flag = 1 << split_idx
+        nr_lines, nr_duplicates = 0, 0
+        overlap = {earlier : 0 for earlier in present}
+        with open(split_file, 'r') as f:
+            for line in f:
+                nr_lines += 1
+                previous = index.update(fingerprint(line.strip()), flag)
+                if previous & flag:
+                    nr_duplicates += 1
+                for earlier in present:
+                    if previous & (1 << SPLITS.index(earlier)):
+                        overlap[earlier] += 1
+        present.append(split)
+        report['lines'][split] = nr_lines
+        report['duplicates'][split] = nr_duplicates
+        for earlier, count in overlap.items():
+            report['overlap'][split + '_in_' + earlier] = count
+    return(report)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_file', type=str, help='Data file to deduplicate')
+    parser.add_argument('--output_file', type=str, help='Deduplicated data file (default: data file with _dedup)')
+    parser.add_argument('--split_dir', type=str, help='random_split directory to report duplicates and overlap for')
+    parser.add_argument('--memory_mb', type=int, help='Memory budget of the in-memory index', default=256)
+    parser.add_argument('--disk_index', type=str, help='Use an on-disk SQLite index at this path instead')
+    opt = parser.parse_args()
+
+    if not opt.data_file and not opt.split_dir:
+        parser.error('Data file or split directory required.')
+
+    if opt.data_file:
+        output_file = opt.output_file or os.path.splitext(opt.data_file)[0] + '_dedup.txt'
+        index = make_index(opt.memory_mb * 2 ** 20, opt.disk_index)
+        nr_lines, nr_removed = deduplicate(opt.data_file, output_file, index)
+        index.close()
+        print('Removed ' + str(nr_removed) + ' of ' + str(nr_lines) + ' lines; result in ' + output_file)
+
+    if opt.split_dir:
+        index = make_index(opt.memory_mb * 2 ** 20, opt.disk_index and opt.disk_index + '.splits')
+        report = overlap_report(opt.split_dir, index)
+        index.close()
+        for split, nr_lines in report['lines'].items():
+            print(split + ': ' + str(nr_lines) + ' lines, ' + str(report['duplicates'][split]) + ' duplicates')
+        for pair, count in report['overlap'].items():
+            later = pair.split('_in_')[0]
+            print(pair + ': ' + str(count) + ' (' + '{:.2%}'.format(count / max(report['lines'][later], 1)) + ')')
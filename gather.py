@@ -0,0 +1,196 @@
+"""
+Evaluate PCFG SET trees as gather-index programs.
+
+Every function of the task only rearranges or duplicates the tokens of its arguments,
+so the target of a tree is a selection from its concatenated string arguments. A tree
+is compiled into the indices of that selection (its program), and the targets of a
+whole batch of trees then follow from one numpy.take over a buffer of token ids.
+
+Programs only depend on the shape of a tree (its functions and argument lengths), so
+trees of the same shape, such as placeholder trees filled with different arguments,
+share one compiled program.
+
+"""
+
+import argparse
+import numpy as np
+
+from interpret_set import interpret, get_inputs
+
+class GatherCompiler():
+    def __init__(self, unary_functions, binary_functions, max_cached_shapes=100000):
+        self.functions = unary_functions + binary_functions
+        self.function_ids = {func : idx for idx, func in enumerate(self.functions)}
+        self.function_ids.update({func.__name__ : idx for idx, func in enumerate(self.functions)})
+        self.is_unary = [True for func in unary_functions] + [False for func in binary_functions]
+
+        self.programs = {}
+        self.max_cached_shapes = max_cached_shapes
+
+    def tree_shape(self, tree):
+        # Prefix order shape of a nested list tree from MarkovTree.build: function ids,
+        # and the negated length of each string argument. Also returns the leaves
+        function_ids = self.function_ids
+        shape = []
+        leaves = []
+        stack = [tree]
+        while stack:
+            item = stack.pop()
+            func_id = function_ids.get(item[0])
+            if func_id is None:
+                shape.append(-len(item))
+                leaves += item
+            else:
+                shape.append(func_id)
+                if self.is_unary[func_id]:
+                    stack.append(item[1])
+                else:
+                    stack += [item[2], item[1]]
+        return(tuple(shape), leaves)
+
+    def token_shape(self, tokens):
+        # Same for a source sequence, with or without brackets
+        function_ids = self.function_ids
+        shape = []
+        leaves = []
+        arg_length = 0
+        for token in tokens:
+            func_id = function_ids.get(token)
+            if func_id is not None:
+                shape.append(func_id)
+            elif token == '(':
+                continue
+            elif token == ')' or token == ',':
+                if arg_length:
+                    shape.append(-arg_length)
+                    arg_length = 0
+            else:
+                leaves.append(token)
+                arg_length += 1
+        if arg_length:
+            shape.append(-arg_length)
+        return(tuple(shape), leaves)
+
+    def program(self, shape):
+        # Indices into the leaves that give the target of a tree of this shape
+        if shape in self.programs:
+            return(self.programs[shape])
+
+        starts = []
+        nr_leaves = 0
+        for node in shape:
+            if node < 0:
+                starts.append(nr_leaves)
+                nr_leaves -= node
+
+        # Evaluate the prefix order shape backwards, on leaf indices instead of tokens
+        values = []
+        for node in reversed(shape):
+            if node < 0:
+                start = starts.pop()
+                values.append(list(range(start, start - node)))
+            elif self.is_unary[node]:
+                values[-1] = self.functions[node](values[-1])
+            else:
+                arg1 = values.pop()
+                values[-1] = self.functions[node](arg1, values[-1])
+        program = np.array(values[0], dtype=np.int32)
+
+        if len(self.programs) >= self.max_cached_shapes:
+            self.programs.clear()
+        self.programs[shape] = program
+        return(program)
+
+    def compile_tree(self, tree):
+        shape, leaves = self.tree_shape(tree)
+        return(leaves, self.program(shape))
+
+    def compile_tokens(self, tokens):
+        shape, leaves = self.token_shape(tokens)
+        return(leaves, self.program(shape))
+
+class GatherBatch():
+    """
+    Token id buffer and concatenated programs of a batch of compiled trees.
+    """
+    def __init__(self, compiler):
+        self.compiler = compiler
+        self.token_ids = {}
+        self.tokens = []
+        self.buffer = []
+        self.programs = []
+        self.target_lengths = []
+
+    def __len__(self):
+        return(len(self.programs))
+
+    def add(self, leaves, program):
+        token_ids = self.token_ids
+        offset = len(self.buffer)
+        for token in leaves:
+            token_id = token_ids.get(token)
+            if token_id is None:
+                token_id = token_ids[token] = len(self.tokens)
+                self.tokens.append(token)
+            self.buffer.append(token_id)
+        self.programs.append(program + offset)
+        self.target_lengths.append(len(program))
+
+    def add_tree(self, tree):
+        self.add(*self.compiler.compile_tree(tree))
+
+    def add_tokens(self, tokens):
+        self.add(*self.compiler.compile_tokens(tokens))
+
+    def target_ids(self):
+        # One gather for the whole batch: flat target token ids, and the end of each target
+        if not self.programs:
+            return(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64))
+        buffer = np.array(self.buffer, dtype=np.int32)
+        target_ids = np.take(buffer, np.concatenate(self.programs))
+        return(target_ids, np.cumsum(self.target_lengths))
+
+    def targets(self):
+        target_ids, ends = self.target_ids()
+        target_tokens = np.array(self.tokens, dtype=object)[target_ids].tolist()
+        starts = [0] + ends[:-1].tolist()
+        return([target_tokens[start : end] for start, end in zip(starts, ends.tolist())])
+
+def verify_trees(pcfg_tree, trees):
+    # Compare gathered targets of MarkovTree trees against evaluate_tree and, for
+    # trees written with brackets, against interpret
+    batch = GatherBatch(GatherCompiler(pcfg_tree.unary_functions, pcfg_tree.binary_functions))
+    for tree in trees:
+        batch.add_tree(tree)
+
+    for tree, target in zip(trees, batch.targets()):
+        written_tree, output = pcfg_tree.write_and_evaluate(tree)
+        assert target == output, 'Gathered target {} does not equal evaluate_tree output {}'.format(target, output)
+        if not pcfg_tree.omit_brackets:
+            assert target == interpret(written_tree.split()), 'Gathered target {} does not equal interpret output for {}'.format(target, written_tree)
+    return(len(trees))
+
+def verify_file(file, unary_functions, binary_functions):
+    # Compare gathered targets for a data file with brackets against interpret and the stored targets
+    inputs = get_inputs(file)
+    batch = GatherBatch(GatherCompiler(unary_functions, binary_functions))
+    for input in inputs:
+        batch.add_tokens(input)
+
+    with open(file, 'r') as f:
+        for input, target, line in zip(inputs, batch.targets(), f):
+            assert target == interpret(input), 'Gathered target {} does not equal interpret output for {}'.format(target, ' '.join(input))
+            assert target == line.split('\t')[1].split(), 'Gathered target {} does not equal stored target in {}'.format(target, line)
+    return(len(inputs))
+
+if __name__ == '__main__':
+    import tasks
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, help='The PCFG SET task to use', default='default')
+    parser.add_argument('--file', type=str, help='Data file with brackets to verify', default='data/pcfg_set/10K/pcfg_10funcs_520letters_brackets.txt')
+    opt = parser.parse_args()
+
+    task = getattr(tasks, opt.task)
+    nr_verified = verify_file(opt.file, task.unary_functions, task.binary_functions)
+    print('Verified gathered targets of ' + str(nr_verified) + ' samples in ' + opt.file)
@@ -1,31 +1,58 @@
 import argparse
+import collections
+import copy
+import os
+import pickle
 import random
-import tasks
+import shutil
 import sys
+import time
+import tasks
 
-from naturalize import DataNaturalization
+from arguments import ArgumentAllocator, ArgumentSpaceExhausted
+from compact import TreeBatch
+from profiling import RunProfile, PROFILE_STAGES
+from split_data import split_data
 
 class MarkovTree():
     """
     PCFG
     """
-    def __init__(self, unary_functions, binary_functions, alphabet, prob_unary, prob_func, lengths, placeholders, omit_brackets):
-        sys.setrecursionlimit(50)
+    def __init__(self, unary_functions, binary_functions, alphabet, prob_unary, prob_func, lengths, placeholders, omit_brackets, seed=None,
+                 max_length=None, max_depth=None):
+        self.rng = random.Random(seed)
 
         self.unary_functions = unary_functions
         self.binary_functions = binary_functions
         self.all_functions = self.unary_functions + self.binary_functions
+        # Dispatch tables, indexed by function id
+        self.function_ids = {func : idx for idx, func in enumerate(self.all_functions)}
+        self.function_names = [func.__name__ for func in self.all_functions]
+        self.function_is_unary = [True for func in self.unary_functions] + [False for func in self.binary_functions]
 
         self.alphabet = alphabet
 
         self.set_probabilities(prob_unary, prob_func)
 
         self.lengths = lengths
-        self.string_arguments = []
-        self.arg_length_counts = {i : len(self.alphabet) ** i for i in self.lengths}
+        # Keeps string arguments unique, also over shards made with the same key
+        self.arguments = ArgumentAllocator(self.alphabet, key=self.rng.getrandbits(64))
 
         self.placeholders = placeholders
         self.omit_brackets = omit_brackets
+        # How each function is written: whether it is unary, and what comes before and after
+        # its arguments
+        opening, closing = ('{} ', '') if omit_brackets else ('{} ( ', ' )')
+        self.call_syntax = {func : (self.function_is_unary[idx], opening.format(func.__name__), closing)
+                            for func, idx in self.function_ids.items()}
+
+        self.set_budgets(max_length, max_depth)
+        # Fail like the old recursion limit did where the depth budget refuses a function,
+        # instead of drawing a string there
+        self.raise_past_depth = False
+        self.constraint_counts = collections.Counter()
+        # TreeBatch that build samples into, instead of returning nested lists
+        self.batch = None
 
     def set_probabilities(self, prob_unary, prob_func):
         self.prob_unary = prob_unary
@@ -34,100 +61,668 @@ class MarkovTree():
         self.prob_func = prob_func
         self.prob_str = 1 - self.prob_func
 
-    def function_next(self):
+    def shard(self, shard_idx, nr_shards, seed):
+        # Restrict this generator to one of nr_shards disjoint parts of the argument space,
+        # so that string arguments remain unique when the shards are merged
+        self.rng = random.Random(seed)
+        self.arguments.shard(shard_idx, nr_shards)
+
+    def settings(self):
+        # What a checkpoint can only be resumed with if it is the same
+        return({'functions' : self.function_names,
+                'alphabet' : list(self.alphabet),
+                'lengths' : list(self.lengths),
+                'placeholders' : self.placeholders,
+                'omit_brackets' : self.omit_brackets,
+                'max_length' : self.max_length,
+                'max_depth' : self.max_depth})
+
+    def get_state(self):
+        # Everything that decides the samples still to come, for checkpoints
+        return({'settings' : self.settings(),
+                'rng' : self.rng.getstate(),
+                'prob_unary' : self.prob_unary,
+                'prob_func' : self.prob_func,
+                'arguments' : self.arguments.get_state(),
+                'constraint_counts' : dict(self.constraint_counts)})
+
+    def set_state(self, state):
+        if state['settings'] != self.settings():
+            raise ValueError('Generator state is of a MarkovTree with other settings')
+        self.rng.setstate(state['rng'])
+        self.set_probabilities(state['prob_unary'], state['prob_func'])
+        self.arguments.set_state(state['arguments'])
+        self.constraint_counts = collections.Counter(state['constraint_counts'])
+
+    def set_budgets(self, max_length, max_depth):
+        # Written trees are kept shorter than max_length characters, and functions are
+        # nested at most max_depth deep. Strings are budgeted at their longest spelling
+        # until drawn, so that every open argument slot can still be filled
+        self.max_length = max_length
+        self.max_depth = max_depth
+        self.length_limit = float('inf') if max_length is None else max_length - 1
+        self.depth_limit = float('inf') if max_depth is None else max_depth
+
+        letter_length = 1 if self.placeholders else max(len(letter) for letter in self.alphabet)
+        self.string_costs = {i : i * letter_length + i - 1 for i in self.lengths}
+
+        bracket_costs = (1, 4) if self.omit_brackets else (5, 8)
+        self.function_costs = {}
+        for func in self.unary_functions:
+            self.function_costs[func] = len(func.__name__) + bracket_costs[0]
+        for func in self.binary_functions:
+            self.function_costs[func] = len(func.__name__) + bracket_costs[1]
+        self.update_min_costs(self.lengths)
+
+    def update_min_costs(self, lengths):
+        # Cheapest string and cheapest complete subtree for each arity
+        self.min_string_cost = min(self.string_costs[i] for i in lengths)
+        self.min_unary_cost = min(self.function_costs[func] for func in self.unary_functions) + self.min_string_cost
+        self.min_binary_cost = min(self.function_costs[func] for func in self.binary_functions) + 2 * self.min_string_cost
+
+    def function_fits(self, depth):
+        # Whether some function can still be placed at this depth
+        return(depth <= self.depth_limit and
+               self.used_length + self.reserved_length + min(self.min_unary_cost, self.min_binary_cost) <= self.length_limit)
+
+    def fitting_functions(self, functions, nr_args):
+        room = self.length_limit - self.used_length - self.reserved_length - nr_args * self.min_string_cost
+        return([func for func in functions if self.function_costs[func] <= room])
+
+    def function_next(self, depth):
         # Determine item following arbitrary function call
-        if random.random() < self.prob_unary:
-            return([random.choice(self.unary_functions), self.unary_next()])
+        unary = self.rng.random() < self.prob_unary
+        functions = self.unary_functions if unary else self.binary_functions
+        fitting = self.fitting_functions(functions, 1 if unary else 2)
+        if not fitting:
+            unary = not unary
+            fitting = self.fitting_functions(self.unary_functions if unary else self.binary_functions, 1 if unary else 2)
+
+        func = self.rng.choice(fitting)
+        self.used_length += self.function_costs[func]
+        if self.batch is not None:
+            # Sampled straight into the arrays of the batch, in prefix order
+            self.batch.append_function(self.function_ids[func])
+        if unary:
+            arg1 = self.unary_next(depth)
+            return(None if self.batch is not None else [func, arg1])
         else:
-            [arg1, arg2] = self.binary_next()
-            return([random.choice(self.binary_functions), arg1, arg2])
-
-    def unary_next(self):
+            arg1, arg2 = self.binary_next(depth)
+            return(None if self.batch is not None else [func, arg1, arg2])
+
+    def function_or_string(self, draw_function, depth):
+        if draw_function:
+            if self.function_fits(depth + 1):
+                return(self.function_next(depth + 1))
+            if self.raise_past_depth and depth + 1 > self.depth_limit:
+                raise RecursionError('Function drawn deeper than max_depth=' + str(self.max_depth))
+        return(self.string_argument())
+
+    def unary_next(self, depth):
         # Determine item following unary function call
-        if random.random() < self.prob_func:
-            return(self.function_next())
-        else:
-            return (self.string_argument())
+        return(self.function_or_string(self.rng.random() < self.prob_func, depth))
 
-    def binary_next(self):
+    def binary_next(self, depth):
         # Determine items following binary function call
-        next = []
-
-        for i in range(2):
-            if random.random() < self.prob_str:
-                next += [self.string_argument()]
-            else:
-                next += [self.function_next()]
-        return(next)
+        # Keep room for the second argument while sampling the first
+        self.reserved_length += self.min_string_cost
+        arg1 = self.function_or_string(not self.rng.random() < self.prob_str, depth)
+        self.reserved_length -= self.min_string_cost
+        arg2 = self.function_or_string(not self.rng.random() < self.prob_str, depth)
+        return(arg1, arg2)
 
     def string_argument(self):
+        # Only consider lengths for which unused arguments are left
+        lengths = self.arguments.available(self.lengths)
+        if not lengths:
+            raise ArgumentSpaceExhausted('No unused string arguments left of lengths ' + str(self.lengths))
+        room = self.length_limit - self.used_length - self.reserved_length
+        fitting = [i for i in lengths if self.string_costs[i] <= room]
+        # Only when the shortest length is used up during this sample can nothing fit
+        candidate_len = self.rng.choice(fitting if fitting else lengths[:1])
+
         if not self.placeholders:
-            candidate = [random.choice(self.alphabet) for i in range(random.choice(self.lengths))]
-            if not candidate in self.string_arguments:
-                # make sure that the same string arguments do not occur
-                self.string_arguments += [candidate]
-                return(candidate)
-            else:
-                return(self.string_argument())
+            candidate = self.arguments.draw(candidate_len)
+            self.used_length += sum(len(letter) for letter in candidate) + candidate_len - 1
         else:
-            candidate_len = random.choice(self.lengths)
-            if not self.arg_length_counts[candidate_len] == 0:
-                self.arg_length_counts[candidate_len] -= 1
-                return(['X' for i in range(candidate_len)])
-            else:
-                return(self.string_argument())
+            self.arguments.reserve(candidate_len)
+            self.used_length += 2 * candidate_len - 1
+            candidate = ['X' for i in range(candidate_len)]
+        if self.batch is not None:
+            self.batch.append_string(candidate)
+            return(None)
+        return(candidate)
 
     def build(self):
         # Always start with function call
-        tree = self.function_next()
-        return(tree)
-
-    def generate_data(self, nr_samples):
-        data = [self.build() for i in range(nr_samples)]
+        self.used_length = 0
+        self.reserved_length = 0
+        lengths = self.arguments.available(self.lengths)
+        if lengths and self.string_costs[min(lengths)] != self.min_string_cost:
+            self.update_min_costs(lengths)
+        if not self.function_fits(1):
+            raise ValueError('No tree fits within max_length=' + str(self.max_length) + ', max_depth=' + str(self.max_depth))
+
+        return(self.function_next(1))
+
+    def generate_data(self, nr_samples, compact=False):
+        # With compact, trees are sampled straight into the arrays of a TreeBatch (see
+        # compact.TreeBatch), without building nested lists. The samples are the same
+        if compact:
+            data = TreeBatch(self)
+            self.batch = data
+            try:
+                for i in range(nr_samples):
+                    try:
+                        self.build()
+                    except BaseException:
+                        data.discard_tree()
+                        raise
+                    data.end_tree()
+            finally:
+                self.batch = None
+        else:
+            data = [self.build() for i in range(nr_samples)]
         return(data)
 
+    def write_and_evaluate(self, tree):
+        # Convert tree to its string for the data file and evaluate its output. Most trees
+        # are a single call on strings, done right away. Other trees are walked recursively,
+        # which is fastest, and only trees nested too deep for that go over the explicit
+        # stack of write_and_evaluate_iterative
+        calls = self.call_syntax
+        func = tree[0]
+        call = calls.get(func)
+        if call is None:
+            return(' '.join(tree), tree)
+        unary, opening, closing = call
+        arg1 = tree[1]
+        if unary:
+            if not arg1[0] in calls:
+                return(opening + ' '.join(arg1) + closing, func(arg1))
+        else:
+            arg2 = tree[2]
+            if not arg1[0] in calls and not arg2[0] in calls:
+                return(opening + ' '.join(arg1) + ' , ' + ' '.join(arg2) + closing, func(arg1, arg2))
+        try:
+            return(write_and_evaluate_subtree(tree, calls))
+        except RecursionError:
+            return(self.write_and_evaluate_iterative(tree))
+
+    def write_and_evaluate_iterative(self, tree):
+        # The same in one pass over an explicit stack holding subtrees (lists), source
+        # tokens (strings) and function applications (function ids), for any depth.
+        # Functions over strings only are written and applied right away
+        function_ids = self.function_ids
+        functions = self.all_functions
+        names = self.function_names
+        is_unary = self.function_is_unary
+        brackets = not self.omit_brackets
+
+        pieces = []
+        values = []
+        stack = [tree]
+        while stack:
+            item = stack.pop()
+            item_type = type(item)
+            if item_type is list:
+                func_id = function_ids.get(item[0])
+                if func_id is None:
+                    pieces.append(' '.join(item))
+                    values.append(item)
+                    continue
+
+                arg1 = item[1]
+                arg1_is_str = not arg1[0] in function_ids
+                if is_unary[func_id]:
+                    if arg1_is_str:
+                        if brackets:
+                            pieces += [names[func_id], '(', ' '.join(arg1), ')']
+                        else:
+                            pieces += [names[func_id], ' '.join(arg1)]
+                        values.append(functions[func_id](arg1))
+                    else:
+                        pieces.append(names[func_id])
+                        if brackets:
+                            pieces.append('(')
+                            stack += [func_id, ')', arg1]
+                        else:
+                            stack += [func_id, arg1]
+                else:
+                    arg2 = item[2]
+                    if arg1_is_str and not arg2[0] in function_ids:
+                        if brackets:
+                            pieces += [names[func_id], '(', ' '.join(arg1), ',', ' '.join(arg2), ')']
+                        else:
+                            pieces += [names[func_id], ' '.join(arg1), ',', ' '.join(arg2)]
+                        values.append(functions[func_id](arg1, arg2))
+                    else:
+                        pieces.append(names[func_id])
+                        if brackets:
+                            pieces.append('(')
+                            stack += [func_id, ')', arg2, ',', arg1]
+                        else:
+                            stack += [func_id, arg2, ',', arg1]
+            elif item_type is str:
+                pieces.append(item)
+            elif is_unary[item]:
+                values[-1] = functions[item](values[-1])
+            else:
+                arg2 = values.pop()
+                values[-1] = functions[item](values[-1], arg2)
+        return(' '.join(pieces), values[0])
+
     def evaluate_tree(self, tree):
         # Evaluate output
-        if all(isinstance(item, str) for item in tree):
-            return(tree)
-        if tree[0] in self.unary_functions:
-            return(tree[0](self.evaluate_tree(tree[1])))
-        elif tree[0] in self.binary_functions:
-            return(tree[0](self.evaluate_tree(tree[1]), self.evaluate_tree(tree[2])))
+        return(self.write_and_evaluate(tree)[1])
 
     def write(self, tree):
         # Convert tree to string for data file
-        if all(isinstance(item, str) for item in tree):
-            return(' '.join(tree))
-        if tree[0] in self.unary_functions:
-            if self.omit_brackets:
-                return (tree[0].__name__ + ' ' + self.write(tree[1]))
-            else:
-                return(tree[0].__name__ + ' ( ' + self.write(tree[1])) + ' )'
-        elif tree[0] in self.binary_functions:
-            if self.omit_brackets:
-                return (tree[0].__name__ + ' ' + self.write(tree[1]) + ' , ' + self.write(tree[2]))
+        return(self.write_and_evaluate(tree)[0])
+
+    def tree_statistics(self, tree):
+        # Depth and length as tree_stats computes them from the written tree, with or
+        # without brackets: nesting of function calls plus one, and the number of tokens
+        # other than brackets
+        function_ids = self.function_ids
+        max_depth = 0
+        length = 0
+        stack = [(tree, 1)]
+        while stack:
+            item, depth = stack.pop()
+            func_id = function_ids.get(item[0])
+            if func_id is None:
+                length += len(item)
+            elif self.function_is_unary[func_id]:
+                max_depth = max(max_depth, depth)
+                length += 1
+                stack.append((item[1], depth + 1))
             else:
-                return(tree[0].__name__ + ' ( ' + self.write(tree[1]) + ' , ' + self.write(tree[2]) + ' )')
+                max_depth = max(max_depth, depth)
+                # Function name and comma
+                length += 2
+                stack += [(item[1], depth + 1), (item[2], depth + 1)]
+        return(max_depth + 1, length)
+
+def write_and_evaluate_subtree(item, calls):
+    # Source and output of a subtree, for MarkovTree.write_and_evaluate
+    func = item[0]
+    call = calls.get(func)
+    if call is None:
+        return(' '.join(item), item)
+    unary, opening, closing = call
+    source1, output1 = write_and_evaluate_subtree(item[1], calls)
+    if unary:
+        return(opening + source1 + closing, func(output1))
+    source2, output2 = write_and_evaluate_subtree(item[2], calls)
+    return(opening + source1 + ' , ' + source2 + closing, func(output1, output2))
+
+# The post-hoc filters that the budgets replaced: written trees of 500 characters or
+# more were dropped, and so were trees whose sampling hit the recursion limit of 50,
+# which allowed at most 21 nested calls (measured on Python 3.11)
+OLD_MAX_LENGTH = 500
+OLD_MAX_DEPTH = 21
+
+def checkpoint_file(data_root):
+    return(data_root + '.ckpt')
+
+def save_checkpoint(file, state):
+    # Written under a temporary name first, so a crash never leaves half a checkpoint
+    temporary = file + '.tmp'
+    with open(temporary, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(temporary, file)
+
+def remove_checkpoint(file):
+    if os.path.exists(file):
+        os.remove(file)
+
+def sample_line(pcfg_tree, random_probs, profile=None, seconds=None):
+    """
+    Build one sample as a data line (source \t target \n), with new random probabilities
+    first if random_probs. Returns None if the sample is dropped for exceeding max_length.
+    Raises ArgumentSpaceExhausted and RecursionError. The build, write_and_evaluate and
+    filter stages are added to seconds if given.
+    """
+    t = pcfg_tree
+    if random_probs:
+        t.set_probabilities(prob_unary=t.rng.random(),
+                            prob_func = t.rng.random())
+    clock = time.perf_counter
+    start = clock()
+    if profile is not None:
+        profile.enable('build')
+    try:
+        tree = t.build()
+    finally:
+        if profile is not None:
+            profile.disable('build')
+    built = clock()
+    if profile is not None:
+        profile.enable('write_and_evaluate')
+    written_tree, output = t.write_and_evaluate(tree)
+    if profile is not None:
+        profile.disable('write_and_evaluate')
+    written = clock()
+
+    # Only needed when the shortest argument length is used up within a sample
+    if t.max_length is None or len(written_tree) < t.max_length:
+        line = written_tree + '\t' + ' '.join(output) + '\n'
+    else:
+        t.constraint_counts['overflow'] += 1
+        line = None
+    if seconds is not None:
+        seconds['build'] += built - start
+        seconds['write_and_evaluate'] += written - built
+        seconds['filter'] += clock() - written
+    return(line)
+
+def generate_data(pcfg_tree, total_samples, data_root, random_probs, profile=None, checkpoint_every=0, resume=False):
+    """
+    Write total_samples samples to data_root.txt. With checkpoint_every, the state of
+    the generator and the size of the output are saved to data_root.ckpt every that
+    many samples (and at the end). With resume, generation continues from that
+    checkpoint, after cutting the output back to its size at the checkpoint, and
+    gives the same output as a run without interruption.
+    """
+    t = pcfg_tree
+    output_file_name = data_root + '.txt'
+    checkpoint = checkpoint_file(data_root)
+    if profile is None:
+        profile = RunProfile()
+
+    # Stages are timed inline, a context manager per sample would cost more than filtering
+    clock = time.perf_counter
+    seconds = collections.Counter()
+    # Samples whose stages were timed, which is fewer than total_samples when samples
+    # are dropped or generation stops early
+    nr_timed = 0
+    counts = collections.Counter()
+    start_idx = 0
+    mode = 'w'
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            state = pickle.load(f)
+        if state['total_samples'] != total_samples or state['random_probs'] != random_probs:
+            raise ValueError('Checkpoint ' + checkpoint + ' is of a run with other settings')
+        if not os.path.exists(output_file_name) or os.path.getsize(output_file_name) < state['offset']:
+            raise ValueError('Output file ' + output_file_name + ' is shorter than at checkpoint ' + checkpoint)
+        t.set_state(state['tree'])
+        start_idx = state['sample_idx']
+        seconds.update(state['seconds'])
+        nr_timed = state['nr_timed']
+        counts.update(state['counts'])
+        with open(output_file_name, 'r+') as f:
+            f.truncate(state['offset'])
+        mode = 'a'
+        print('Resuming at sample ' + str(start_idx) + ' of ' + str(total_samples) + ' from ' + checkpoint)
+    elif resume:
+        print('No checkpoint ' + checkpoint + ', starting from the beginning')
+
+    def checkpoint_state(sample_idx, output_file):
+        output_file.flush()
+        return({'total_samples' : total_samples,
+                'random_probs' : random_probs,
+                'sample_idx' : sample_idx,
+                'offset' : output_file.tell(),
+                'tree' : t.get_state(),
+                'seconds' : dict(seconds),
+                'nr_timed' : nr_timed,
+                'counts' : dict(counts)})
+
+    end_idx = total_samples
+    with open(output_file_name, mode) as output_file:
+        for i in range(start_idx, total_samples):
+            if checkpoint_every and i != start_idx and i % checkpoint_every == 0:
+                save_checkpoint(checkpoint, checkpoint_state(i, output_file))
+            try:
+                line = sample_line(t, random_probs, profile, seconds)
+            except ArgumentSpaceExhausted as e:
+                print('Stopped after ' + str(i) + ' samples: ' + str(e))
+                counts['not_generated_arguments_exhausted'] += total_samples - i
+                break
+            except RecursionError:
+                counts['dropped_recursion_error'] += 1
+                continue
+            start = clock()
+            if line is not None:
+                output_file.write(line)
+                counts['samples_written'] += 1
+            seconds['write_file'] += clock() - start
+            nr_timed += 1
+
+        if checkpoint_every:
+            # Resuming a finished run only keeps its output
+            save_checkpoint(checkpoint, checkpoint_state(end_idx, output_file))
+
+    for name in ['build', 'write_and_evaluate', 'filter', 'write_file']:
+        profile.seconds[name] += seconds[name]
+        profile.calls[name] += nr_timed
+    profile.counters.update(counts)
+    profile.count('samples_requested', total_samples)
+    profile.count('arguments_handed_out', t.arguments.nr_handed_out())
+    profile.count('argument_cycle_walks', t.arguments.nr_walks())
+    return(output_file_name)
 
-def generate_data(pcfg_tree, total_samples, data_root, random_probs):
+class TargetHistogram():
+    """
+    Quotas of samples per (depth, length) bucket, in proportion to a target
+    distribution, with probabilities per bucket that adapt to the samples drawn
+    while aiming for it. Buckets are depth // depth_interval, length // length_interval.
+    """
+    def __init__(self, depths, lengths, total_samples, depth_interval=1, length_interval=1):
+        self.depth_interval = depth_interval
+        self.length_interval = length_interval
+        counts = collections.Counter(self.bucket(depth, length) for depth, length in zip(depths, lengths))
+
+        # Largest remainder rounding, so the quotas add up to total_samples
+        nr_targets = sum(counts.values())
+        shares = {bucket : count * total_samples / nr_targets for bucket, count in counts.items()}
+        self.quotas = {bucket : int(share) for bucket, share in shares.items()}
+        remainders = sorted(shares, key=lambda bucket: (self.quotas[bucket] - shares[bucket], bucket))
+        for bucket in remainders[:total_samples - sum(self.quotas.values())]:
+            self.quotas[bucket] += 1
+        self.quotas = {bucket : quota for bucket, quota in self.quotas.items() if quota > 0}
+
+        self.remaining = dict(self.quotas)
+        self.probabilities = {}
+        self.misses = collections.Counter()
+        self.nr_draws = 0
+
+    def bucket(self, depth, length):
+        return(depth // self.depth_interval, length // self.length_interval)
+
+    def bounds(self, bucket):
+        # Smallest and largest depth and length in a bucket
+        depth_cat, length_cat = bucket
+        return(depth_cat * self.depth_interval, (depth_cat + 1) * self.depth_interval - 1,
+               length_cat * self.length_interval, (length_cat + 1) * self.length_interval - 1)
+
+    def open_buckets(self):
+        return([bucket for bucket in sorted(self.remaining) if self.remaining[bucket] > 0])
+
+    def accept(self, depth, length):
+        # Count a sample towards its bucket if that still has room
+        bucket = self.bucket(depth, length)
+        if self.remaining.get(bucket, 0) > 0:
+            self.remaining[bucket] -= 1
+            return(True)
+        return(False)
+
+    def adapt(self, bucket, depth, length, step=0.02):
+        # Move the probabilities used for bucket towards samples that land in it. More
+        # function calls give deeper and longer samples, more unary calls among them
+        # deeper samples for their length
+        prob_unary, prob_func = self.probabilities[bucket]
+        min_depth, max_depth, min_length, max_length = self.bounds(bucket)
+        if length < min_length:
+            prob_func += step
+            prob_unary -= step
+        elif length > max_length:
+            prob_func -= step
+            prob_unary += step
+        if depth < min_depth:
+            prob_func += step
+            prob_unary += step
+        elif depth > max_depth:
+            prob_func -= step
+        self.probabilities[bucket] = (min(max(prob_unary, step), 1 - step), min(max(prob_func, step), 1 - step))
+
+def generate_targeted_data(pcfg_tree, histogram, data_root, patience=1000, profile=None):
+    """
+    Sample into the buckets of a TargetHistogram until all quotas are filled. Every
+    draw aims for a bucket picked in proportion to its remaining quota, with that
+    bucket's probabilities and its largest depth as depth budget, and is kept if it
+    lands in any bucket with room left. Buckets that receive no sample in patience
+    draws aimed at them in a row are given up.
+    """
     t = pcfg_tree
     output_file_name = data_root + '.txt'
-    output_file = open(output_file_name, 'w')
+    max_depth = t.max_depth
+    if profile is None:
+        profile = RunProfile()
+
+    with open(output_file_name, 'w') as output_file:
+        buckets = histogram.open_buckets()
+        while buckets:
+            bucket = t.rng.choices(buckets, weights=[histogram.remaining[b] for b in buckets])[0]
+            if not bucket in histogram.probabilities:
+                histogram.probabilities[bucket] = (t.prob_unary, t.prob_func)
+            t.set_probabilities(*histogram.probabilities[bucket])
+            # The depth of a sample is its nesting of function calls plus one
+            bucket_depth = histogram.bounds(bucket)[1] - 1
+            t.set_budgets(t.max_length, bucket_depth if max_depth is None else min(max_depth, bucket_depth))
+
+            try:
+                with profile.stage('build'):
+                    tree = t.build()
+            except ArgumentSpaceExhausted as e:
+                print('Stopped after ' + str(histogram.nr_draws) + ' draws: ' + str(e))
+                break
+            except ValueError:
+                # Not even the smallest tree fits the depth of this bucket
+                buckets.remove(bucket)
+                continue
+            histogram.nr_draws += 1
+
+            depth, length = t.tree_statistics(tree)
+            with profile.stage('write_and_evaluate'):
+                written_tree, output = t.write_and_evaluate(tree)
+            landed = histogram.bucket(depth, length)
+            overflow = t.max_length is not None and len(written_tree) >= t.max_length
+            if overflow:
+                t.constraint_counts['overflow'] += 1
+            elif histogram.accept(depth, length):
+                output_file.write(written_tree + '\t' + ' '.join(output) + '\n')
+                if landed in buckets and not histogram.remaining[landed]:
+                    buckets.remove(landed)
+
+            # Samples dropped as overflow count as misses, also in the bucket aimed for,
+            # so a bucket that only yields overflows is given up as well
+            if landed == bucket and not overflow:
+                histogram.misses[bucket] = 0
+                continue
+            histogram.adapt(bucket, depth, length)
+            histogram.misses[bucket] += 1
+            if histogram.misses[bucket] >= patience and bucket in buckets:
+                buckets.remove(bucket)
+
+    t.set_budgets(t.max_length, max_depth)
+    nr_missing = sum(histogram.remaining.values())
+    profile.count('targeted_draws', histogram.nr_draws)
+    profile.count('samples_requested', sum(histogram.quotas.values()))
+    profile.count('samples_written', sum(histogram.quotas.values()) - nr_missing)
+    profile.count('not_generated_unreachable_buckets', nr_missing)
+    profile.count('arguments_handed_out', t.arguments.nr_handed_out())
+    profile.count('argument_cycle_walks', t.arguments.nr_walks())
+    print('Targeted generation: ' + str(sum(histogram.quotas.values()) - nr_missing) + ' samples in ' + str(histogram.nr_draws) + ' draws')
+    if nr_missing:
+        unfilled = [bucket for bucket in sorted(histogram.remaining) if histogram.remaining[bucket]]
+        print('  ' + str(nr_missing) + ' samples missing in ' + str(len(unfilled)) + ' unreachable (depth, length) buckets: ' + str(unfilled))
+    return(output_file_name)
 
-    for i in range(total_samples):
+def probe_old_filters(pcfg_tree, nr_samples, random_probs, seed=None):
+    """
+    How many of nr_samples samples the post-hoc filters that the budgets replaced would
+    have rejected. They are sampled from a copy of pcfg_tree without the length budget,
+    that fails like the old recursion limit: 'too_deep' counts samples that would nest
+    calls deeper than OLD_MAX_DEPTH, and 'too_long' those of OLD_MAX_LENGTH characters
+    or more. As in the old generate_data, too deep samples are not checked for length.
+    """
+    t = copy.deepcopy(pcfg_tree)
+    t.rng = random.Random(seed)
+    t.set_budgets(None, OLD_MAX_DEPTH)
+    t.raise_past_depth = True
+    counts = collections.Counter()
+    for i in range(nr_samples):
         if random_probs:
-            t.set_probabilities(prob_unary=random.random(),
-                                prob_func = random.random())
+            t.set_probabilities(prob_unary=t.rng.random(),
+                                prob_func = t.rng.random())
         try:
             tree = t.build()
-            written_tree = t.write(tree)
-
-            # Control maximum tree size
-            if len(written_tree) < 500:
-                output_file.write(written_tree+ '\t' + ' '.join(t.evaluate_tree(tree)) + '\n')
+        except ArgumentSpaceExhausted:
+            break
         except RecursionError:
-            pass
+            tree = None
+        counts['probed'] += 1
+        if tree is None:
+            counts['too_deep'] += 1
+        elif len(t.write(tree)) >= OLD_MAX_LENGTH:
+            counts['too_long'] += 1
+    return(counts)
+
+def report_constraints(constraint_counts, old_filter_counts=None):
+    if old_filter_counts is not None:
+        nr_probed = str(old_filter_counts['probed'])
+        print('Samples the old filters would have rejected, of ' + nr_probed + ' sampled without budgets:')
+        print('  too long (' + str(OLD_MAX_LENGTH) + ' characters or more): ' + str(old_filter_counts['too_long']) + ' / ' + nr_probed)
+        print('  too deep (recursion limit, over ' + str(OLD_MAX_DEPTH) + ' nested calls): ' + str(old_filter_counts['too_deep']) + ' / ' + nr_probed)
+    if constraint_counts['overflow']:
+        print('Dropped after exceeding max_length: ' + str(constraint_counts['overflow']))
+
+def shard_seeds(seed, nr_shards):
+    # Derive one seed per shard from the master seed
+    rng = random.Random(seed)
+    return([rng.getrandbits(64) for i in range(nr_shards)])
+
+def generate_shard(pcfg_tree, shard_idx, nr_shards, seed, total_samples, shard_root, random_probs, profile_stage=None,
+                   checkpoint_every=0, resume=False):
+    pcfg_tree.shard(shard_idx, nr_shards, seed)
+    profile = RunProfile(profile_stage)
+    shard_file = generate_data(pcfg_tree, total_samples, shard_root, random_probs, profile, checkpoint_every, resume)
+    profile.dump_profile(shard_root + '.prof')
+    return(shard_file, pcfg_tree.constraint_counts, profile)
+
+def generate_data_parallel(pcfg_tree, total_samples, data_root, random_probs, workers, seed, profile=None,
+                           checkpoint_every=0, resume=False):
+    # Split samples over a process pool, then merge the shards in order. Every shard
+    # keeps its own checkpoint until the shards are merged
+    seeds = shard_seeds(seed, workers)
+    shard_sizes = [total_samples // workers + (1 if i < total_samples % workers else 0) for i in range(workers)]
+    profile_stage = None if profile is None else profile.profile_stage
+    shard_roots = [data_root + '_shard' + str(i) for i in range(workers)]
+    jobs = [(pcfg_tree, i, workers, seeds[i], shard_sizes[i], shard_roots[i], random_probs, profile_stage, checkpoint_every, resume) for i in range(workers)]
+
+    import multiprocessing
+    with multiprocessing.Pool(workers) as pool:
+        shard_results = pool.starmap(generate_shard, jobs)
+
+    # Shards and their checkpoints are only removed once the merged output is in place,
+    # so a crash during the merge can still be resumed
+    output_file_name = data_root + '.txt'
+    temporary = output_file_name + '.tmp'
+    with open(temporary, 'w') as output_file:
+        for shard_file, constraint_counts, shard_profile in shard_results:
+            with open(shard_file, 'r') as f:
+                shutil.copyfileobj(f, output_file)
+            pcfg_tree.constraint_counts.update(constraint_counts)
+            if profile is not None:
+                # Stage times become totals over all processes
+                profile.merge(shard_profile)
+    os.replace(temporary, output_file_name)
+    for (shard_file, constraint_counts, shard_profile), shard_root in zip(shard_results, shard_roots):
+        os.remove(shard_file)
+        remove_checkpoint(checkpoint_file(shard_root))
 
     return(output_file_name)
 
@@ -138,31 +733,72 @@ if __name__ == '__main__':
     parser.add_argument('--random_probs', action='store_true', help='Use different random probabilities for each sample')
     parser.add_argument('--prob_unary', type=float, help='P(unary|function)', default=0.75)
     parser.add_argument('--prob_func', type=float, help='P(function|argument)', default=0.25)
-    parser.add_argument('--lengths', type=int, help='Lengths of string arguments', default=[2, 3, 4, 5])
+    parser.add_argument('--params_file', type=str, help='Data file to estimate prob_unary and prob_func from, instead of the values given')
+    parser.add_argument('--lengths', type=int, nargs='+', help='Lengths of string arguments', default=[2, 3, 4, 5])
     parser.add_argument('--nr_samples', type=int, help='Number of samples to generate', default=2500)
     parser.add_argument('--no_split', action='store_true', help='Do not split into train and test yet')
     parser.add_argument('--train_ratio', type=float, help='Fraction of generated data to use for training', default=0.8)
+    parser.add_argument('--dev_ratio', type=float, help='Fraction of generated data to use for development (default: a third of the rest)', default=None)
     parser.add_argument('--data_root', type=str, help='Data path root')
     parser.add_argument('--placeholder_args', action='store_true', help='Generate data with placeholder arguments, containing only X characters')
     parser.add_argument('--omit_brackets', action='store_true', help='Do not use brackets')
     parser.add_argument('--naturalize', action='store_true', help='Impose natural language distribution on data')
     parser.add_argument('--nl_file', type=str, help='Natural language file to mimic distribution from')
+    parser.add_argument('--max_length', type=int, help='Written samples are shorter than this many characters', default=500)
+    parser.add_argument('--max_depth', type=int, help='Maximum nesting depth of function calls', default=20)
+    parser.add_argument('--probe_old_filters', type=int, help='Sample this many extra trees without budgets, to count how many the old length filter and recursion limit would have rejected', default=0)
+    parser.add_argument('--workers', type=int, help='Number of processes to generate with', default=1)
+    parser.add_argument('--target_dist', action='store_true', help='Sample straight into the depth and length distribution of --nl_file (default: WMT test), instead of discarding data to match it')
+    parser.add_argument('--depth_interval', type=int, help='Width of the depth buckets of --target_dist', default=1)
+    parser.add_argument('--length_interval', type=int, help='Width of the length buckets of --target_dist', default=1)
+    parser.add_argument('--seed', type=int, help='Master random seed; shard seeds are derived from it', default=None)
+    parser.add_argument('--checkpoint_every', type=int, help='Save a checkpoint every this many samples (per worker), to continue with --resume', default=0)
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run from its checkpoint, with the same arguments')
+    parser.add_argument('--report', type=str, help='Write counters and times per stage to this JSON file')
+    parser.add_argument('--profile', type=str, choices=PROFILE_STAGES, help='Run this stage under cProfile')
+    parser.add_argument('--profile_file', type=str, help='Where to save the cProfile data (default: data root + _<stage>.prof)')
     opt = parser.parse_args()
 
     if not opt.data_root:
         parser.error('Data path root required.')
 
+    if opt.target_dist and opt.workers > 1:
+        parser.error('--target_dist generates with one process.')
+    if opt.target_dist and (opt.checkpoint_every or opt.resume):
+        parser.error('--target_dist runs cannot be checkpointed.')
+    if opt.resume and opt.workers > 1 and opt.seed is None:
+        parser.error('Resuming a run with several workers needs its --seed.')
+
     if opt.naturalize:
         opt.random_probs = True
         opt.placeholder_args = True
         opt.no_split = True
 
+    profile = RunProfile(opt.profile)
+    run_start = time.perf_counter()
+
     task = getattr(tasks, opt.task)
 
     unary_functions = task.unary_functions
     binary_functions = task.binary_functions
     alphabet = [letter + str(i) for letter in task.alphabet for i in range(1, opt.alphabet_ratio + 1)]
 
+    # Naturalization needs numpy and CoreNLP access, so it is only imported when used
+    if opt.params_file or opt.target_dist or opt.naturalize:
+        from naturalize import DataNaturalization, DEPTHS_WMT_TEST, LENGTHS_WMT_TEST
+
+    if opt.params_file:
+        # Step 5 of the naturalization recipe: regenerate with the parameters of earlier data
+        opt.prob_unary, opt.prob_func = DataNaturalization(alphabet=alphabet,
+                                                           unary_functions=unary_functions,
+                                                           binary_functions=binary_functions).get_pcfg_params(opt.params_file, processes=opt.workers)
+        print('Estimated prob_unary={0:.4f}, prob_func={1:.4f} from {2}'.format(opt.prob_unary, opt.prob_func, opt.params_file))
+
+    if opt.seed is None:
+        # Drawn here, so the seed in the run report rebuilds the same data, argument
+        # key and shard seeds included
+        opt.seed = random.getrandbits(32)
+
     pcfg_tree_generator = MarkovTree(unary_functions=unary_functions,
                    binary_functions=binary_functions,
                    alphabet=alphabet,
@@ -170,41 +806,102 @@ if __name__ == '__main__':
                    prob_func=opt.prob_func,
                    lengths=opt.lengths,
                    placeholders=opt.placeholder_args,
-                   omit_brackets=opt.omit_brackets)
-
-
-    output_file = generate_data(pcfg_tree=pcfg_tree_generator,
-                  total_samples=opt.nr_samples,
-                  data_root=opt.data_root,
-                  random_probs=opt.random_probs)
+                   omit_brackets=opt.omit_brackets,
+                   seed=opt.seed,
+                   max_length=opt.max_length,
+                   max_depth=opt.max_depth)
+
+    if opt.target_dist:
+        if opt.nl_file is None:
+            depths, lengths = DEPTHS_WMT_TEST, LENGTHS_WMT_TEST
+        else:
+            depths, lengths = DataNaturalization(alphabet=alphabet,
+                                                 unary_functions=unary_functions,
+                                                 binary_functions=binary_functions).get_tree_statistics(opt.nl_file, type='nl')
+        histogram = TargetHistogram(depths, lengths, opt.nr_samples, opt.depth_interval, opt.length_interval)
+        output_file = generate_targeted_data(pcfg_tree=pcfg_tree_generator,
+                      histogram=histogram,
+                      data_root=opt.data_root,
+                      profile=profile)
+    elif opt.workers > 1:
+        output_file = generate_data_parallel(pcfg_tree=pcfg_tree_generator,
+                      total_samples=opt.nr_samples,
+                      data_root=opt.data_root,
+                      random_probs=opt.random_probs,
+                      workers=opt.workers,
+                      seed=opt.seed,
+                      profile=profile,
+                      checkpoint_every=opt.checkpoint_every,
+                      resume=opt.resume)
+    else:
+        output_file = generate_data(pcfg_tree=pcfg_tree_generator,
+                      total_samples=opt.nr_samples,
+                      data_root=opt.data_root,
+                      random_probs=opt.random_probs,
+                      profile=profile,
+                      checkpoint_every=opt.checkpoint_every,
+                      resume=opt.resume)
+        remove_checkpoint(checkpoint_file(opt.data_root))
+
+    old_filter_counts = None
+    if opt.probe_old_filters:
+        old_filter_counts = probe_old_filters(pcfg_tree_generator, opt.probe_old_filters, opt.random_probs, opt.seed)
+        profile.count('old_filters_probed', old_filter_counts['probed'])
+        profile.count('old_filters_too_long', old_filter_counts['too_long'])
+        profile.count('old_filters_too_deep', old_filter_counts['too_deep'])
+    report_constraints(pcfg_tree_generator.constraint_counts, old_filter_counts)
+    profile.count('dropped_max_length', pcfg_tree_generator.constraint_counts['overflow'])
+
+    if not opt.no_split:
+        with profile.stage('split'):
+            split_dir, split_counts = split_data(output_file, opt.train_ratio, opt.dev_ratio)
+        print('Split ' + ', '.join(split + ': ' + str(count) for split, count in split_counts.items()) + ' into ' + split_dir)
 
     if opt.naturalize:
         naturalizer = DataNaturalization(alphabet=alphabet,
                                          unary_functions=unary_functions,
                                          binary_functions=binary_functions)
 
-        depth_intervals = range(1, 2)
-        length_intervals = range(1, 6)
-
-        opt_kl_div = 999
-        for depth_interval in depth_intervals:
-            for length_interval in length_intervals:
-                try:
-                    # Default: mimic English WMT test file
-                    kl_div, new_output_file = naturalizer.force_dist_on_data(
-                        data_gold_dist=opt.nl_file,
-                        data_to_be_transformed=output_file,
-                        depth_interval=depth_interval,
-                        length_interval=length_interval)
-                    if kl_div < opt_kl_div:
-                        opt_kl_div = kl_div
-                        opt_dep_len = (depth_interval, length_interval)
-                        opt_file = new_output_file
-                except:
-                    pass
-
-        print('Best results for depth_interval={0}, length_interval={1}'.format(opt_dep_len[0], opt_dep_len[1]))
-
-        naturalizer.finalize(file=opt_file)
+        if opt.target_dist:
+            # Generated in the target distribution already
+            opt_file = output_file
+        else:
+            depth_intervals = range(1, 2)
+            length_intervals = range(1, 6)
+
+            # Default: mimic English WMT test file
+            with profile.stage('naturalize'):
+                opt_kl_div, opt_file, opt_dep_len, grid_results = naturalizer.search_dist_on_data(
+                    data_gold_dist=opt.nl_file,
+                    data_to_be_transformed=output_file,
+                    depth_intervals=depth_intervals,
+                    length_intervals=length_intervals)
+
+            print('Best results for depth_interval={0}, length_interval={1}'.format(opt_dep_len[0], opt_dep_len[1]))
+            profile.info['naturalize_grid'] = [{'depth_interval' : intervals[0], 'length_interval' : intervals[1], 'kl_divergence' : kl_div, 'samples' : nr_samples}
+                                               for intervals, (kl_div, nr_samples) in sorted(grid_results.items())]
+            profile.info['naturalize_best'] = {'depth_interval' : opt_dep_len[0], 'length_interval' : opt_dep_len[1], 'kl_divergence' : opt_kl_div}
+
+        with profile.stage('finalize'):
+            naturalizer.finalize(file=opt_file, processes=opt.workers, seed=opt.seed, profile=profile)
+
+    if opt.report or opt.profile:
+        profile.print_summary()
+    if opt.report:
+        profile.write_report(opt.report, arguments=vars(opt), total_seconds=time.perf_counter() - run_start)
+        print('Run report written to ' + opt.report)
+    if opt.profile:
+        stats = profile.profile_stats()
+        if stats is None:
+            print('Stage ' + opt.profile + ' did not run, nothing was profiled')
+        else:
+            profile_file = opt.profile_file or opt.data_root + '_' + opt.profile + '.prof'
+            stats.dump_stats(profile_file)
+            for shard_profile_file in profile.profile_files:
+                os.remove(shard_profile_file)
+            stats.stream = sys.stdout
+            stats.sort_stats('cumulative').print_stats(20)
+            print('cProfile data of stage ' + opt.profile + ' saved to ' + profile_file)
 
 # python3 generate.py --alphabet_ratio 20 --random_probs --nr_samples 100000 --no_split --data_root 'pcfg_10funcs_520letters_100K' --placeholder_args --naturalize
+# python3 generate.py --alphabet_ratio 20 --nr_samples 100000 --data_root 'pcfg_10funcs_520letters_100K' --naturalize --target_dist
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import OrderedDict
 import tasks
 
 task_name = 'default'
@@ -12,6 +12,7 @@ UNARY_DICT = {func.__name__ : func for func in UNARY}
 BINARY_DICT = {func.__name__ : func for func in BINARY}
 
 FUNC_NAMES = set([func.__name__ for func in FUNC])
+FUNC_DICT = {**UNARY_DICT, **BINARY_DICT}
 
 def get_inputs(file):
     inputs = []
@@ -24,32 +25,135 @@ def get_inputs(file):
 def is_basestring(input):
     return(list(set(input) & FUNC_NAMES) == [])
 
-def interpret(input):
-    #print(input)
-    func_name = input[0]
+class InterpretationCache():
+    """
+    Bounded memo of subexpression outputs, evicting the least recently used.
 
-    if func_name in UNARY_DICT.keys():
-        func = UNARY_DICT[func_name]
-        arg = get_arguments(input, nr_arguments=1)
-        if is_basestring(arg):
-            # base case
-            return(func(arg))
+    Subexpressions are hash-consed: a function call is keyed by its function name and,
+    per argument, the tokens of a string or the id of a nested call. Keys therefore
+    stay small for deep expressions. Ids are never reused, so a call whose nested call
+    was evicted gets a new key instead of a wrong output. Whole inputs are stored as
+    well, so a repeated sample costs a single lookup.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return(len(self.entries))
+
+    def __repr__(self):
+        return('InterpretationCache(' + ', '.join(key + '=' + str(value) for key, value in self.stats().items()) + ')')
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+        return(entry)
+
+    def store(self, key, output):
+        entry = self.entries[key] = (self.next_id, output)
+        self.next_id += 1
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return(entry)
+
+    def call(self, func_name, args, arg_keys):
+        # Id and output of a function call, applying the function only on a miss
+        key = (func_name, *arg_keys)
+        entry = self.lookup(key)
+        if entry is None:
+            entry = self.store(key, FUNC_DICT[func_name](*args))
+        return(entry)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return({'hits' : self.hits,
+                'misses' : self.misses,
+                'hit_rate' : round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions' : self.evictions,
+                'size' : len(self.entries),
+                'maxsize' : self.maxsize})
+
+def interpret_cached(input, cache):
+    # As interpret, with every call looked up in the cache. Each open call also
+    # holds the keys of its finished arguments, and the id of the argument being
+    # read if that is a function call. Repeated inputs are looked up as a whole first
+    if not input or not input[0] in FUNC_DICT:
+        return(None)
+
+    input_key = tuple(input)
+    entry = cache.lookup(input_key)
+    if entry is not None:
+        return(list(entry[1]))
+
+    calls = []
+    for token in input:
+        if token in FUNC_DICT:
+            calls.append([token, [], [], [], None])
+        elif token == '(':
+            continue
+        elif token == ',' or token == ')':
+            call = calls[-1]
+            call[1].append(call[2])
+            call[3].append(tuple(call[2]) if call[4] is None else call[4])
+            if token == ',':
+                call[2] = []
+                call[4] = None
+                continue
+
+            func_name, args, arg, arg_keys, arg_id = calls.pop()
+            output_id, output = cache.call(func_name, args, arg_keys)
+            if not calls:
+                cache.store(input_key, output)
+                # Cached outputs are shared, so hand out a copy
+                return(list(output))
+            calls[-1][2] = output
+            calls[-1][4] = output_id
         else:
-            return(func(interpret(arg)))
-
-    elif func_name in BINARY_DICT.keys():
-        func = BINARY_DICT[func_name]
-        arg1, arg2 = get_arguments(input, nr_arguments=2)
-        if is_basestring(arg1):
-            if is_basestring(arg2):
-                return(func(arg1, arg2))
-            else:
-                return(func(arg1, interpret(arg2)))
+            calls[-1][2].append(token)
+
+def interpret(input, cache=None):
+    # Single pass over the tokens, keeping a stack of open function calls. Each call
+    # holds its function, its finished arguments and the argument being read
+    if cache is not None:
+        return(interpret_cached(input, cache))
+    if not input or not input[0] in FUNC_DICT:
+        return(None)
+
+    calls = []
+    for token in input:
+        if token in FUNC_DICT:
+            calls.append([FUNC_DICT[token], [], []])
+        elif token == '(':
+            continue
+        elif token == ',':
+            call = calls[-1]
+            call[1].append(call[2])
+            call[2] = []
+        elif token == ')':
+            func, args, arg = calls.pop()
+            args.append(arg)
+            output = func(*args)
+            if not calls:
+                return(output)
+            calls[-1][2] = output
         else:
-            if is_basestring(arg2):
-                return(func(interpret(arg1), arg2))
-            else:
-                return(func(interpret(arg1), interpret(arg2)))
+            calls[-1][2].append(token)
+
+def interpret_batch(inputs, cache=None):
+    return([interpret(input, cache) for input in inputs])
+
+def interpret_file(file, cache=None):
+    return(interpret_batch(get_inputs(file), cache))
 
 def get_arguments(input, nr_arguments):
 
@@ -98,56 +202,67 @@ def is_basecall(sample):
     func = sample[0]
     return((func in UNARY_DICT.keys() and is_basestring(sample[1])) or (func in BINARY_DICT.keys() and is_basestring(sample[1]) and is_basestring(sample[2])))
 
+def extract_substructures(sample):
+    # Substructures of all levels in a single pass: every argument of a function at
+    # bracket level l that is itself a function call is a substructure of level l.
+    # Outputs are those of the nested calls, computed on the way. Each open call
+    # holds its function, level, position, finished arguments, the argument being
+    # read, where that argument starts and whether it is a call
+    calls = []
+    levels = {}
+    found = []
+    for idx, token in enumerate(sample):
+        if token in FUNC_DICT:
+            level = len(calls) + 1
+            levels.setdefault(level, [])
+            calls.append([FUNC_DICT[token], level, idx, [], [], idx + 2, False])
+        elif token == ',' or token == ')':
+            call = calls[-1]
+            if call[6]:
+                found.append((call[2], len(call[3]), call[1], sample[call[5] : idx], call[4]))
+            call[3].append(call[4])
+            if token == ',':
+                call[4] = []
+                call[5] = idx + 1
+                call[6] = False
+                continue
+
+            func, level, func_idx, args = calls.pop()[:4]
+            if not calls:
+                break
+            calls[-1][4] = func(*args)
+            calls[-1][6] = True
+        elif token != '(':
+            calls[-1][4].append(token)
+
+    # Calls finish innermost first, so restore the order of the functions in the sample
+    found.sort(key=lambda sub: sub[:2])
+    for func_idx, arg_nr, level, sub, output in found:
+        levels[level].append((sub, output))
+    return(levels)
+
 def get_substructures(sample):
-    sub_dict = defaultdict(list)
-    global_bracket_count = 1
-    for idx, item in enumerate(sample):
-        if item == '(':
-            global_bracket_count += 1
-        if item == ')':
-            global_bracket_count -= 1
-        if item in FUNC_NAMES:
-            if item in UNARY_DICT.keys():
-                subs = []
-                local_bracket_count = 1
-                next_idx = idx + 2
-                open_idx = next_idx
-                while local_bracket_count != 0:
-                    if sample[next_idx] == '(':
-                        local_bracket_count += 1
-                    if sample[next_idx] == ')':
-                        local_bracket_count -= 1
-                    next_idx += 1
-                subs += [sample[open_idx : next_idx - 1]]
-            elif item in BINARY_DICT.keys():
-                subs = []
-                local_bracket_count = 1
-                next_idx = idx + 2
-                open_idx = next_idx
-                while local_bracket_count != 0:
-                    if sample[next_idx] == '(':
-                        local_bracket_count += 1
-                    if sample[next_idx] == ')':
-                        local_bracket_count -= 1
-                    if local_bracket_count == 1 and sample[next_idx] == ',':
-                        comma_idx = next_idx
-                    next_idx += 1
-                subs += [sample[open_idx : comma_idx], sample[comma_idx + 1 : next_idx - 1]]
-            sub_dict[global_bracket_count] += [sub for sub in subs if not is_basestring(sub)]
-    return(dict(sub_dict))
+    return({level : [sub for sub, output in subs] for level, subs in extract_substructures(sample).items()})
+
+def get_substructures_by_levels(filein, fileouts):
+    # Write the substructures of several levels (a dict from level to output file)
+    # in one pass over the input file
+    fouts = {level : open(fileout, 'w') for level, fileout in fileouts.items()}
+    try:
+        with open(filein, 'r') as fin:
+            for line in fin:
+                input = line.split('\t')[0].split()
+                for level, subs in extract_substructures(input).items():
+                    if level in fouts:
+                        for sub, output in subs:
+                            fouts[level].write(' '.join(sub) + '\t' + ' '.join(output))
+                            fouts[level].write('\n')
+    finally:
+        for fout in fouts.values():
+            fout.close()
 
 def get_substructures_by_level(filein, fileout, level):
-    inputs = get_inputs(filein)
-    with open(fileout, 'w') as fout:
-        for input in inputs:
-            sub_dict = get_substructures(input)
-            if level in sub_dict.keys():
-                subs = sub_dict[level]
-                for sub in subs:
-                    output = interpret(sub)
-                    fout.write(' '.join(sub) + '\t' + ' '.join(output))
-                    fout.write('\n')
-
-# for i in [1,2,3]:
-#     for d in ['train', 'test']:
-#         get_substructures_by_level('markov_sentences_' + d + '.txt', 'data/markov_sub/' + d + '/markov_' + d + '_sub' + str(i) + '.txt', level=i)
\ No newline at end of file
+    get_substructures_by_levels(filein, {level : fileout})
+
+# for d in ['train', 'test']:
+#     get_substructures_by_levels('markov_sentences_' + d + '.txt', {i : 'data/markov_sub/' + d + '/markov_' + d + '_sub' + str(i) + '.txt' for i in [1,2,3]})
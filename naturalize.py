@@ -23,18 +23,23 @@ to generate more: repeat 6 and 7 with higher nr samples
 
 """
 
-from pycorenlp import StanfordCoreNLP
 import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
 import numpy as np
-import seaborn as sns
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import operator
 import random
 import itertools
 import sys
 
+import tasks
+import tree_stats
+from chunks import map_chunks, read_chunks
+from arguments import ArgumentAllocator, ArgumentSpaceExhausted
 from utils import DataLoader
 from interpret_set import interpret
 
@@ -79,6 +84,100 @@ class DependencyParseNL():
         else:
             return(max([self.get_tree_depth(tree[subtree]) for subtree in tree]) + 1)
 
+class CoreNLPAnnotator():
+    """
+    Concurrent client for a local Stanford CoreNLP server. Every worker thread keeps
+    its own session, so connections are pooled rather than opened per sentence.
+    """
+    def __init__(self, server_url='http://localhost:9000', workers=8):
+        self.server_url = server_url.rstrip('/')
+        self.workers = workers
+        self.properties = json.dumps({'annotators': 'tokenize,ssplit,depparse', 'outputFormat': 'json'})
+        self.local = threading.local()
+
+    def check_server(self):
+        # requests is only needed, and imported, for parsing natural language
+        import requests
+        try:
+            requests.get(self.server_url)
+        except requests.exceptions.ConnectionError:
+            raise Exception('Check whether you have started the CoreNLP server, see the top of naturalize.py')
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            import requests
+            self.local.session = requests.Session()
+        return(self.local.session)
+
+    def annotate(self, sentence):
+        response = self.session().post(self.server_url, params={'properties': self.properties}, data=sentence.encode('utf-8'))
+        response.raise_for_status()
+        return(response.json())
+
+    def tree_statistics(self, sentence):
+        d = DependencyParseNL(self.annotate(sentence))
+        return(d.depth, d.length)
+
+    def map_tree_statistics(self, sentences, chunk_size=1000):
+        # (depth, length) per sentence, in order; sentences are sent in chunks so
+        # results can be stored while the rest is parsed
+        self.check_server()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            for start in range(0, len(sentences), chunk_size):
+                chunk = sentences[start : start + chunk_size]
+                for sentence, stats in zip(chunk, executor.map(self.tree_statistics, chunk)):
+                    yield(sentence, stats)
+
+class DependencyStatsCache():
+    """
+    (depth, length) of parsed sentences, keyed by a hash of the sentence, in an
+    append-only tab-separated file. Sentences in the cache are never parsed again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stats = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                end = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Cut off by a crash while appending: drop it, so the next
+                        # entry starts on a line of its own
+                        break
+                    end += len(line)
+                    try:
+                        key, depth, length = line.decode('utf-8').split('\t')
+                        self.stats[key] = (int(depth), int(length))
+                    except ValueError:
+                        # Not an entry, skipped
+                        continue
+            if end < os.path.getsize(path):
+                os.truncate(path, end)
+        self.file = None
+
+    def __contains__(self, sentence):
+        return(self.key(sentence) in self.stats)
+
+    def __getitem__(self, sentence):
+        return(self.stats[self.key(sentence)])
+
+    def key(self, sentence):
+        return(hashlib.sha1(sentence.encode('utf-8')).hexdigest())
+
+    def add(self, sentence, depth, length):
+        key = self.key(sentence)
+        if key in self.stats:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.stats[key] = (depth, length)
+        self.file.write(key + '\t' + str(depth) + '\t' + str(length) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
 class DependencyParsePCFG():
     def __init__(self, sample, alphabet):
         self.sample = self.process_sample(sample)
@@ -105,6 +204,81 @@ class DependencyParsePCFG():
         depth = max(open_bracket_counts) + 1
         return(depth)
 
+def count_pcfg_chunk(lines, function_ids, nr_functions):
+    """
+    Counts for get_pcfg_params over a chunk of lines: calls per function id, string
+    arguments per length, and samples. Tokens are mapped to ids with one dict lookup
+    each: function ids, -1 for brackets and commas, nr_functions for anything else
+    (letters and placeholders). The rest is counted on the id array.
+    """
+    token_ids = []
+    for line in lines:
+        token_ids += [function_ids.get(token, nr_functions) for token in line.split('\t')[0].split()]
+        # Separates samples, so no string argument runs over into the next line
+        token_ids.append(-1)
+    token_ids = np.array(token_ids, dtype=np.int64)
+
+    function_counts = np.bincount(token_ids[(token_ids >= 0) & (token_ids < nr_functions)], minlength=nr_functions)
+    # String arguments are maximal runs of string tokens
+    is_string = np.concatenate([[False], token_ids == nr_functions, [False]])
+    edges = np.flatnonzero(is_string[1:] != is_string[:-1])
+    length_counts = np.bincount(edges[1::2] - edges[::2])
+    return(function_counts, length_counts, len(lines))
+
+def placeholder_runs(source):
+    # Lengths of the runs of placeholder arguments (X) in a source sequence
+    return([len(list(run)) for token, run in itertools.groupby(source) if token == 'X'])
+
+def finalize_chunk(lines, chunk_idx, counters, settings):
+    # Fill in and evaluate one chunk of DataNaturalization.finalize. Argument counters
+    # start where the previous chunks end; samples that cannot be completed are counted
+    rng = random.Random(settings['seed'] * 1000003 + chunk_idx)
+    arguments = ArgumentAllocator(settings['alphabet'], settings['key'])
+    arguments.counters = dict(counters)
+    unary_names, binary_names = set(settings['unary_names']), set(settings['binary_names'])
+    factor = settings['factor']
+
+    new_lines = []
+    dropped = collections.Counter()
+    nr_args = 0
+    for line in lines:
+        source = line.split('\t')[0].split()
+        for i in range(factor):
+            new_line = []
+            arg_count = 0
+            try:
+                for item in source + [None]:
+                    if arg_count != 0 and item != 'X':
+                        if settings['add_args']:
+                            new_line += arguments.draw(arg_count)
+                            nr_args += 1
+                        else:
+                            new_line += ['X' for j in range(arg_count)]
+                        arg_count = 0
+                    if item is None:
+                        break
+                    if item == 'X':
+                        arg_count += 1
+                    elif factor > 1 and item in unary_names:
+                        new_line += [rng.choice(settings['unary_names'])]
+                    elif factor > 1 and item in binary_names:
+                        new_line += [rng.choice(settings['binary_names'])]
+                    else:
+                        new_line += [item]
+            except ArgumentSpaceExhausted:
+                dropped['no unused arguments'] += 1
+                continue
+
+            try:
+                output = interpret(new_line)
+            except Exception:
+                output = None
+            if output is None:
+                dropped['not interpretable'] += 1
+                continue
+            new_lines += [' '.join(new_line) + '\t' + ' '.join(output) + '\n']
+    return(new_lines, dropped, nr_args)
+
 class DataNaturalization():
     def __init__(self, alphabet, unary_functions, binary_functions):
         sys.setrecursionlimit(500)
@@ -112,37 +286,47 @@ class DataNaturalization():
         self.unary_functions = unary_functions
         self.binary_functions = binary_functions
 
-    def get_tree_statistics(self, file, type):
+    def get_tree_statistics(self, file, type, server_url='http://localhost:9000', workers=8, cache_file=None):
         depths = []
         lengths = []
 
         if type == 'nl':
             dl = DataLoader(file)
             dl.load_data()
-            nlp = StanfordCoreNLP('http://localhost:9000')
-
-            for idx, sentence in enumerate(dl.data):
-                if idx % 1000 == 0:
-                    print('Processing sentence ' + str(idx + 1))
-                output = nlp.annotate(sentence, properties={
-                    'annotators': 'tokenize,ssplit,depparse',
-                    'outputFormat': 'json'
-                })
 
-                d = DependencyParseNL(output)
-                depths += [d.depth]
-                lengths += [d.length]
+            # Only sentences without cached statistics go to the server
+            cache = DependencyStatsCache(cache_file if cache_file is not None else file + '.depstats')
+            to_parse = list(dict.fromkeys(sentence for sentence in dl.data if not sentence in cache))
+            if to_parse:
+                annotator = CoreNLPAnnotator(server_url, workers)
+                try:
+                    for idx, (sentence, (depth, length)) in enumerate(annotator.map_tree_statistics(to_parse)):
+                        if idx % 1000 == 0:
+                            print('Processing sentence ' + str(idx + 1) + ' of ' + str(len(to_parse)))
+                        cache.add(sentence, depth, length)
+                finally:
+                    cache.close()
+
+            for sentence in dl.data:
+                depth, length = cache[sentence]
+                depths += [depth]
+                lengths += [length]
 
         elif type == 'pcfg':
-            with open(file, 'r') as f:
-                for idx, line in enumerate(f):
-                    d = DependencyParsePCFG(line, self.alphabet)
-                    depths += [d.depth]
-                    lengths += [d.length]
+            # Same statistics as DependencyParsePCFG for the whole file at once, except that
+            # lines without brackets get their nesting depth instead of depth 1
+            depths, lengths = tree_stats.get_statistics(file)
+            depths, lengths = depths.tolist(), lengths.tolist()
 
         return(depths, lengths)
 
     def plot_dist(self, var1, var2, name1, name2):
+        # The plotting stack is slow to import, and only needed here
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
+        import pandas as pd
+        import seaborn as sns
+
         sns.set(style="white", color_codes=True, font_scale=1.5)
         df = pd.DataFrame({name1: np.array(var1), name2: np.array(var2)})
         g = sns.JointGrid(x=name1, y=name2, data=df, space=0, xlim=(0,15), ylim=(0,40))
@@ -167,34 +351,59 @@ class DataNaturalization():
             + np.log(np.linalg.det(cov2) / np.linalg.det(cov1)))
         return(kl_div)
 
-    def get_pcfg_params(self, file):
+    def estimate_pcfg_params(self, file, processes=1, chunk_size=100000):
+        """
+        Maximum likelihood estimates of the MarkovTree parameters of a data file, with
+        or without brackets, streamed in chunks: prob_unary and prob_func, and the
+        probability of every function within its arity and of every string length.
+        The functions are those of the task (tasks.default if none were given).
+        """
+        unary_functions = self.unary_functions if self.unary_functions is not None else tasks.default.unary_functions
+        binary_functions = self.binary_functions if self.binary_functions is not None else tasks.default.binary_functions
+        unary_names = self.function_names(unary_functions)
+        binary_names = self.function_names(binary_functions)
+        function_ids = {name : idx for idx, name in enumerate(unary_names + binary_names)}
+        nr_functions = len(function_ids)
+        for token in ['(', ')', ',']:
+            function_ids[token] = -1
+
+        function_counts = np.zeros(nr_functions, dtype=np.int64)
+        length_counts = np.zeros(0, dtype=np.int64)
+        nr_samples = 0
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            with open(file, 'r') as f:
+                jobs = ((lines, function_ids, nr_functions) for lines in read_chunks(f, chunk_size))
+                for chunk_function_counts, chunk_length_counts, chunk_nr_samples in map_chunks(count_pcfg_chunk, jobs, pool, processes):
+                    function_counts += chunk_function_counts
+                    if len(chunk_length_counts) > len(length_counts):
+                        length_counts = np.concatenate([length_counts, np.zeros(len(chunk_length_counts) - len(length_counts), dtype=np.int64)])
+                    length_counts[:len(chunk_length_counts)] += chunk_length_counts
+                    nr_samples += chunk_nr_samples
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        unary_counts = function_counts[:len(unary_names)]
+        binary_counts = function_counts[len(unary_names):]
+        function_count = int(function_counts.sum())
+        string_count = int(length_counts.sum())
+        if function_count == 0:
+            raise ValueError('No function calls of the task found in ' + file)
+
+        # Every function call but the first of a sample fills an argument slot, as does every string
+        params = {'nr_samples' : nr_samples,
+                  'prob_unary' : int(unary_counts.sum()) / function_count,
+                  'prob_func' : (function_count - nr_samples) / (function_count - nr_samples + string_count),
+                  'unary_probs' : {name : count / max(int(unary_counts.sum()), 1) for name, count in zip(unary_names, unary_counts.tolist())},
+                  'binary_probs' : {name : count / max(int(binary_counts.sum()), 1) for name, count in zip(binary_names, binary_counts.tolist())},
+                  'length_probs' : {length : count / string_count for length, count in enumerate(length_counts.tolist()) if count}}
+        return(params)
+
+    def get_pcfg_params(self, file, processes=1, chunk_size=100000):
         # Maximum Likelihood Estimation
-        samples = open(file, 'r').readlines()
-        inputs = [sample.split('\t')[0].split() for sample in samples]
-
-        unary_names = ['copy', 'shift', 'echo', 'reverse']
-        binary_names = ['append', 'prepend']
-
-        nr_samples = len(inputs)
-        unary_count, binary_count, string_count = 0, 0, 0
-        for input in inputs:
-            within_string = False
-            for item in input:
-                if item in unary_names:
-                    unary_count += 1
-                elif item in binary_names:
-                    binary_count += 1
-                elif item in self.alphabet:
-                    if not within_string:
-                        string_count += 1
-                        within_string = True
-                elif item in [')', ',']:
-                    within_string = False
-
-        function_count = unary_count + binary_count
-        prob_unary = unary_count / function_count
-        prob_func = (function_count - nr_samples) / (function_count - nr_samples + string_count)
-        return(prob_unary, prob_func)
+        params = self.estimate_pcfg_params(file, processes, chunk_size)
+        return(params['prob_unary'], params['prob_func'])
 
     def force_dist_on_data(self, data_gold_dist, data_to_be_transformed, depth_interval, length_interval):
         """
@@ -267,62 +476,158 @@ class DataNaturalization():
         #return (transformed_data)
         return(kl_div, output_file)
 
-    def finalize(self, file, factor=1, remove_brackets=True, add_args=True, output_file=True, plot_dist=False):
-        new_file_brackets = file.split('.')[0] + '_times' + str(factor) + '_brackets.txt'
-        if remove_brackets:
-            new_file = file.split('.')[0] + '_times' + str(factor) + '.txt'
-
-        with open(file, 'r') as f:
-            if add_args:
-                args_used = []
-            new_lines = []
-            for idx, line in enumerate(f):
-                line = line.split()
-                for i in range(factor):
-                    new_line = []
-                    arg_count = 0
-                    for item in line:
-                        if arg_count != 0 and item != 'X':
-                            try:
-                                if add_args:
-                                    candidate_arg = [random.choice(self.alphabet) for i in range(arg_count)]
-                                    while candidate_arg in args_used:
-                                        candidate_arg = [random.choice(self.alphabet) for i in range(arg_count)]
-                                    new_line += candidate_arg
-                                    args_used += [candidate_arg]
-                                    arg_count = 0
-                                else:
-                                    new_line += ['X' for i in range(arg_count)]
-                                    arg_count = 0
-                            except:
-                                break
-                        if factor > 1:
-                            if item in self.unary_functions:
-                                new_line += [random.choice(self.unary_functions)]
-                            elif item in self.binary_functions:
-                                 new_line += [random.choice(self.binary_functions)]
-                        elif item == 'X':
-                            arg_count += 1
-                        else:
-                            new_line += [item]
-                    try:
-                        output = interpret(new_line)
-                    except:
-                        break
+    def bucket_counts(self, keys):
+        # Distinct bucket keys, their counts, the first sample in each and each sample's bucket
+        buckets, first_idx, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+        return(buckets, counts, first_idx, inverse)
 
-                    new_lines += [' '.join(new_line) + '\t' + ' '.join(output) + '\n']
+    def select_for_intervals(self, depths_nl, lengths_nl, depths_pcfg, lengths_pcfg, depth_interval, length_interval):
+        """
+        Vectorized selection of force_dist_on_data: a boolean mask over the PCFG samples
+        that keeps, per (depth, length) bucket, the first samples in proportion to the
+        NL histogram. Returns None if the most frequent NL bucket has no PCFG samples.
+        """
+        nr_length_cats = max(lengths_nl.max(), lengths_pcfg.max()) // length_interval + 1
+        keys_nl = (depths_nl // depth_interval) * nr_length_cats + lengths_nl // length_interval
+        keys_pcfg = (depths_pcfg // depth_interval) * nr_length_cats + lengths_pcfg // length_interval
+
+        buckets_nl, counts_nl, first_nl = self.bucket_counts(keys_nl)[:3]
+        # Most frequent NL bucket, ties going to the bucket seen first
+        most_frequent = np.flatnonzero(counts_nl == counts_nl.max())
+        most_likely_comb = buckets_nl[most_frequent[np.argmin(first_nl[most_frequent])]]
+        highest_freq = counts_nl.max()
+
+        buckets_pcfg, counts_pcfg, first_pcfg, inverse_pcfg = self.bucket_counts(keys_pcfg)
+        most_likely_idx = np.searchsorted(buckets_pcfg, most_likely_comb)
+        if most_likely_idx == len(buckets_pcfg) or buckets_pcfg[most_likely_idx] != most_likely_comb:
+            return(None)
+        pcfg_size_most_likely_comb = counts_pcfg[most_likely_idx]
+
+        # Number of samples to include per PCFG bucket, zero for buckets not in the NL data
+        nl_idx = np.minimum(np.searchsorted(buckets_nl, buckets_pcfg), len(buckets_nl) - 1)
+        in_nl = buckets_nl[nl_idx] == buckets_pcfg
+        include_sizes = np.where(in_nl, (counts_nl[nl_idx] / highest_freq * pcfg_size_most_likely_comb).astype(np.int64), 0)
+
+        # Rank of every sample within its bucket, in file order
+        order = np.argsort(inverse_pcfg, kind='stable')
+        bucket_starts = np.concatenate([[0], np.cumsum(counts_pcfg)[:-1]])
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order)) - bucket_starts[inverse_pcfg[order]]
+
+        selected = ranks < include_sizes[inverse_pcfg]
+        # force_dist_on_data writes buckets in order of first appearance
+        output_order = np.lexsort((np.arange(len(order)), first_pcfg[inverse_pcfg]))
+        return(selected, output_order[selected[output_order]])
+
+    def search_dist_on_data(self, data_gold_dist, data_to_be_transformed, depth_intervals, length_intervals):
+        """
+        Grid search over the intervals of force_dist_on_data. Statistics are computed
+        once, every grid cell is evaluated on arrays, and only the transformed data of
+        the cell with the lowest KL divergence is written.
+        """
+        if not data_gold_dist is None:
+            depths_nl, lengths_nl = self.get_tree_statistics(data_gold_dist, type='nl')
+        else:
+            depths_nl, lengths_nl = DEPTHS_WMT_TEST, LENGTHS_WMT_TEST
+        depths_nl, lengths_nl = np.asarray(depths_nl), np.asarray(lengths_nl)
+        depths_pcfg, lengths_pcfg = tree_stats.get_statistics(data_to_be_transformed)
 
-        if output_file:
-            with open(new_file_brackets, 'w') as nf_brackets:
-                for line in new_lines:
-                    nf_brackets.write(line)
-                print('Final file with brackets located at: ')
-                print(new_file_brackets)
+        array_nl = np.stack([depths_nl, lengths_nl], axis=1)
+        mean_nl, cov_nl = np.mean(array_nl, axis=0), np.cov(array_nl, rowvar=0)
+
+        results = {}
+        best = None
+        for depth_interval in depth_intervals:
+            for length_interval in length_intervals:
+                selection = self.select_for_intervals(depths_nl, lengths_nl, depths_pcfg, lengths_pcfg, depth_interval, length_interval)
+                if selection is None:
+                    continue
+                selected, output_order = selection
+                array_trans = np.stack([depths_pcfg[selected], lengths_pcfg[selected]], axis=1)
+                if len(array_trans) < 2:
+                    continue
+                mean_trans, cov_trans = np.mean(array_trans, axis=0), np.cov(array_trans, rowvar=0)
+                try:
+                    kl_div = self.kl_divergence(mean_nl, cov_nl, mean_trans, cov_trans)
+                except np.linalg.LinAlgError:
+                    continue
+                if not np.isfinite(kl_div):
+                    continue
+
+                results[(depth_interval, length_interval)] = (kl_div, len(array_trans))
+                print('Depth interval: ' + str(depth_interval))
+                print('Length interval: ' + str(length_interval))
+                print('Nr of samples: ' + str(len(array_trans)))
+                print('KL divergence: ' + str(kl_div))
+                print('##################################')
+                if best is None or kl_div < best[0]:
+                    best = (kl_div, (depth_interval, length_interval), output_order)
+
+        if best is None:
+            raise ValueError('No interval combination gives a usable transformation of ' + data_to_be_transformed)
+
+        kl_div, (depth_interval, length_interval), output_order = best
+        output_file = data_to_be_transformed.split('.')[0] + '_transformed_intervals_depth_'+ str(depth_interval) + '_length_' + str(length_interval) +'.txt'
+        with open(data_to_be_transformed, 'r') as f:
+            pcfg_data = f.readlines()
+        with open(output_file, 'w') as f:
+            for idx in output_order:
+                f.write(pcfg_data[idx])
+
+        return(kl_div, output_file, (depth_interval, length_interval), results)
+
+    def function_names(self, functions):
+        return([func if isinstance(func, str) else func.__name__ for func in functions])
 
+    def finalize(self, file, factor=1, remove_brackets=True, add_args=True, output_file=True, plot_dist=False,
+                 processes=1, chunk_size=10000, seed=None, profile=None):
+        """
+        Fill in placeholder arguments (and with factor > 1, draw new functions of the
+        same arity) and evaluate the results, streaming the input in chunks of lines.
+        Arguments are unique over the whole output through one keyed ArgumentAllocator:
+        every chunk starts at the counters where the previous chunk ends, so chunks can
+        be processed by several processes and the output does not depend on their number.
+        """
+        new_file_brackets = file.split('.')[0] + '_times' + str(factor) + '_brackets.txt'
+        new_file = file.split('.')[0] + '_times' + str(factor) + '.txt' if remove_brackets else None
+
+        if seed is None:
+            seed = random.getrandbits(64)
+        settings = {'alphabet' : self.alphabet,
+                    'key' : random.Random(seed).getrandbits(64),
+                    'seed' : seed,
+                    'factor' : factor,
+                    'add_args' : add_args,
+                    'unary_names' : self.function_names(self.unary_functions),
+                    'binary_names' : self.function_names(self.binary_functions)}
+
+        dropped = collections.Counter()
+        total_nr_str_sequences = 0
+        nr_samples = 0
+        nf_brackets = open(new_file_brackets, 'w') if output_file else None
+        nf = open(new_file, 'w') if output_file and remove_brackets else None
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            with open(file, 'r') as f:
+                for new_lines, chunk_dropped, chunk_nr_args in self.finalize_chunks(f, settings, chunk_size, pool, processes):
+                    dropped.update(chunk_dropped)
+                    total_nr_str_sequences += chunk_nr_args
+                    nr_samples += len(new_lines)
+                    if nf_brackets is not None:
+                        nf_brackets.writelines(new_lines)
+                    if nf is not None:
+                        nf.writelines(line.replace('( ', '').replace(' )', '') for line in new_lines)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            for out in [nf_brackets, nf]:
+                if out is not None:
+                    out.close()
+
+        if output_file:
+            print('Final file with brackets located at: ')
+            print(new_file_brackets)
             if remove_brackets:
-                with open(new_file, 'w') as nf:
-                    for line in new_lines:
-                        nf.write(line.replace('( ', '').replace(' )', ''))
                 print('Final file without brackets located at: ')
                 print(new_file)
 
@@ -330,8 +635,29 @@ class DataNaturalization():
             depths, lengths = self.get_tree_statistics(new_file_brackets, type='pcfg')
             self.plot_dist(depths, lengths, 'depth', 'length')
 
-        total_nr_str_sequences = len(args_used)
         print('Total nr of string sequences: ' + str(total_nr_str_sequences))
+        for reason, count in sorted(dropped.items()):
+            print('Dropped samples (' + reason + '): ' + str(count))
+        if profile is not None:
+            profile.count('finalize_samples_written', nr_samples)
+            profile.count('finalize_string_sequences', total_nr_str_sequences)
+            for reason, count in dropped.items():
+                profile.count('finalize_dropped_' + reason.replace(' ', '_'), count)
+        return(new_file_brackets, new_file)
+
+    def finalize_chunks(self, f, settings, chunk_size, pool, processes):
+        return(map_chunks(finalize_chunk, self.finalize_jobs(f, settings, chunk_size), pool, processes))
+
+    def finalize_jobs(self, f, settings, chunk_size):
+        # Arguments of finalize_chunk per chunk, with the allocator counters at its start
+        counters = collections.Counter()
+        for chunk_idx, lines in enumerate(read_chunks(f, chunk_size)):
+            chunk_counters = dict(counters)
+            if settings['add_args']:
+                for line in lines:
+                    for length in placeholder_runs(line.split('\t')[0].split()):
+                        counters[length] += settings['factor']
+            yield((lines, chunk_idx, chunk_counters, settings))
 
 # dn = DataNaturalization(alphabet=None, unary_functions=None, binary_functions=None)
 # depth, length = dn.get_tree_statistics('data/pcfg_set/10K/pcfg_10funcs_520letters_brackets.txt', type='pcfg')
@@ -0,0 +1,113 @@
+"""
+Counters and timers for the stages of a generate.py run.
+
+A RunProfile accumulates wall-clock time per stage (build, write_and_evaluate, filter,
+write_file, split, naturalize, finalize) and named counters, such as samples dropped
+per reason. Profiles of parallel shards are merged into one. One stage can additionally be
+run under cProfile. The whole profile can be written as a JSON report.
+
+"""
+
+import collections
+import contextlib
+import io
+import json
+import time
+
+STAGES = ['build', 'write_and_evaluate', 'filter', 'write_file', 'split', 'naturalize', 'finalize']
+# Stages that can be run under cProfile; filtering and writing a line are too small to profile
+PROFILE_STAGES = ['build', 'write_and_evaluate', 'split', 'naturalize', 'finalize']
+
+class RunProfile():
+    def __init__(self, profile_stage=None):
+        self.counters = collections.Counter()
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.info = {}
+        self.profile_stage = profile_stage
+        self.profiler = None
+        if profile_stage is not None:
+            # Imported only when profiling, to keep the start of plain runs fast
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self.profile_files = []
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def enable(self, name):
+        # Turn cProfile on and off around code that is timed without stage()
+        if name == self.profile_stage:
+            self.profiler.enable()
+
+    def disable(self, name):
+        if name == self.profile_stage:
+            self.profiler.disable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Time a stage; time spent in nested stages also counts for the outer one
+        profiled = name == self.profile_stage
+        if profiled:
+            self.profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield()
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+            if profiled:
+                self.profiler.disable()
+
+    def __getstate__(self):
+        # cProfile data cannot be pickled, so shards dump it to a file instead
+        state = dict(self.__dict__)
+        state['profiler'] = None
+        return(state)
+
+    def dump_profile(self, file):
+        if self.profiler is not None:
+            self.profiler.dump_stats(file)
+            self.profile_files.append(file)
+
+    def merge(self, other):
+        # Add the counters and times of a shard; times become totals over processes
+        self.counters.update(other.counters)
+        self.seconds.update(other.seconds)
+        self.calls.update(other.calls)
+        self.profile_files += other.profile_files
+
+    def profile_stats(self):
+        # cProfile data of this process and of dumped shards, None if nothing was profiled
+        sources = []
+        if self.profiler is not None and self.profiler.getstats():
+            sources.append(self.profiler)
+        sources += self.profile_files
+        if not sources:
+            return(None)
+        import pstats
+        stats = pstats.Stats(sources[0], stream=io.StringIO())
+        for source in sources[1:]:
+            stats.add(source)
+        return(stats)
+
+    def report(self):
+        return({'counters' : dict(self.counters),
+                'seconds' : {name : round(seconds, 6) for name, seconds in self.seconds.items()},
+                'calls' : dict(self.calls),
+                'info' : self.info})
+
+    def write_report(self, file, **extra):
+        report = self.report()
+        report.update(extra)
+        with open(file, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+    def print_summary(self):
+        print('Time per stage:')
+        for name in STAGES + sorted(set(self.seconds) - set(STAGES)):
+            if name in self.seconds:
+                print('  {:<20} {:>10.3f}s'.format(name, self.seconds[name]))
+        print('Counters:')
+        for name, count in sorted(self.counters.items()):
+            print('  {:<36} {:>10}'.format(name, count))
@@ -0,0 +1,312 @@
+"""
+Local server that streams PCFG SET samples to trainers, instead of files on disk.
+
+A client connects over a Unix socket or localhost TCP and sends one JSON line with
+the generator settings it wants (any of DEFAULT_SETTINGS, plus nr_samples and seed).
+The server answers with a JSON header line holding the seed of the stream, then one
+source \t target line per sample, then a JSON trailer line. Samples never start with
+'{', so the header and trailer cannot be mistaken for samples. Without nr_samples the
+stream goes on until the client disconnects.
+
+Batches are generated in a process pool, ahead of the client into a bounded queue
+per stream, which is filled as soon as a client connects. A stream that is not read
+stops generating when its queue is full, and a client that reads slowly holds the
+writer back through the socket, so memory per stream is bounded either way. The
+batches of a stream follow each other with the state of its generator, so a stream
+with seed s is the same as the data of `generate.py --seed s` with those settings.
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import tasks
+from arguments import ArgumentSpaceExhausted
+from generate import MarkovTree, sample_line
+
+DEFAULT_PORT = 8765
+
+DEFAULT_SETTINGS = {'task' : 'default',
+                    'alphabet_ratio' : 1,
+                    'prob_unary' : 0.75,
+                    'prob_func' : 0.25,
+                    'random_probs' : False,
+                    'lengths' : [2, 3, 4, 5],
+                    'placeholder_args' : False,
+                    'omit_brackets' : False,
+                    'max_length' : 500,
+                    'max_depth' : 20}
+
+class SampleServerError(Exception):
+    pass
+
+def make_tree(settings, seed):
+    task = getattr(tasks, settings['task'])
+    alphabet = [letter + str(i) for letter in task.alphabet for i in range(1, settings['alphabet_ratio'] + 1)]
+    return(MarkovTree(unary_functions=task.unary_functions,
+                      binary_functions=task.binary_functions,
+                      alphabet=alphabet,
+                      prob_unary=settings['prob_unary'],
+                      prob_func=settings['prob_func'],
+                      lengths=settings['lengths'],
+                      placeholders=settings['placeholder_args'],
+                      omit_brackets=settings['omit_brackets'],
+                      seed=seed,
+                      max_length=settings['max_length'],
+                      max_depth=settings['max_depth']))
+
+def produce_batch(tree, nr_samples, random_probs):
+    # Runs in a producer process, with the same sample_line as generate.generate_data.
+    # Returns the tree with its new state, the lines, and why the stream has to stop
+    lines = []
+    stopped = None
+    for i in range(nr_samples):
+        try:
+            line = sample_line(tree, random_probs)
+        except ArgumentSpaceExhausted as e:
+            stopped = str(e)
+            break
+        except RecursionError:
+            continue
+        if line is not None:
+            lines.append(line)
+    return(tree, lines, stopped)
+
+def stream_settings(request, defaults):
+    # Settings of a stream: the server defaults, updated with those of the request
+    if not isinstance(request, dict):
+        raise ValueError('Request must be a JSON object')
+    unknown = set(request) - set(defaults) - {'nr_samples', 'seed'}
+    if unknown:
+        raise ValueError('Unknown settings: ' + ', '.join(sorted(unknown)))
+    settings = dict(defaults)
+    settings.update((key, value) for key, value in request.items() if key in defaults)
+    if not isinstance(getattr(tasks, str(settings['task']), None), type(tasks)):
+        raise ValueError('Unknown task ' + repr(settings['task']))
+    nr_samples = request.get('nr_samples')
+    if nr_samples is not None and (not isinstance(nr_samples, int) or nr_samples < 0):
+        raise ValueError('nr_samples must be a non-negative integer')
+    return(settings)
+
+class SampleServer():
+    """
+    Streams samples to any number of clients, generated by a shared pool of producer
+    processes. seed only decides the seeds of clients that do not send their own.
+    """
+    def __init__(self, socket_path=None, host='127.0.0.1', port=DEFAULT_PORT, workers=1, batch_size=1000,
+                 buffer_batches=4, defaults=None, seed=None):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.batch_size = batch_size
+        self.buffer_batches = buffer_batches
+        self.defaults = dict(DEFAULT_SETTINGS)
+        self.defaults.update(defaults or {})
+        self.rng = random.Random(seed)
+        self.nr_clients = 0
+        self.nr_samples_served = 0
+        self.pool = None
+        self.server = None
+
+    async def start(self):
+        # Start the producers before there are sockets: forked later, they would inherit
+        # the sockets of clients and keep them open after the clients close them
+        self.pool = ProcessPoolExecutor(self.workers)
+        await asyncio.get_running_loop().run_in_executor(self.pool, os.getpid)
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host=self.host, port=self.port)
+            # Port 0 binds to a free port
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        # Streams still open end with the server
+        open_streams = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in open_streams:
+            task.cancel()
+        await asyncio.gather(*open_streams, return_exceptions=True)
+        await self.server.wait_closed()
+        self.pool.shutdown(cancel_futures=True)
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    def address(self):
+        return(self.socket_path if self.socket_path is not None else (self.host, self.port))
+
+    async def produce(self, tree, settings, nr_samples, queue):
+        # Put batches of lines on the queue until nr_samples are made (or forever if
+        # None), then the reason to stop. Waits whenever the queue is full
+        loop = asyncio.get_running_loop()
+        remaining = nr_samples
+        stopped = None
+        try:
+            while remaining is None or remaining > 0:
+                batch_size = self.batch_size if remaining is None else min(self.batch_size, remaining)
+                tree, lines, stopped = await loop.run_in_executor(self.pool, produce_batch, tree, batch_size, settings['random_probs'])
+                if remaining is not None:
+                    remaining -= len(lines)
+                await queue.put(lines)
+                if stopped is not None:
+                    break
+        except Exception as e:
+            stopped = 'error: ' + str(e)
+        await queue.put(stopped)
+
+    async def handle_client(self, reader, writer):
+        self.nr_clients += 1
+        producer = None
+        try:
+            try:
+                request = json.loads(await reader.readline())
+                settings = stream_settings(request, self.defaults)
+                seed = request.get('seed')
+                if seed is None:
+                    seed = self.rng.getrandbits(32)
+                tree = make_tree(settings, seed)
+            except (ValueError, TypeError) as e:
+                writer.write((json.dumps({'error' : str(e)}) + '\n').encode('utf-8'))
+                await writer.drain()
+                return
+
+            nr_samples = request.get('nr_samples')
+            queue = asyncio.Queue(self.buffer_batches)
+            producer = asyncio.create_task(self.produce(tree, settings, nr_samples, queue))
+            writer.write((json.dumps({'seed' : seed, 'settings' : settings}) + '\n').encode('utf-8'))
+
+            nr_served = 0
+            while True:
+                lines = await queue.get()
+                if not isinstance(lines, list):
+                    stopped = lines
+                    break
+                writer.write(''.join(lines).encode('utf-8'))
+                nr_served += len(lines)
+                self.nr_samples_served += len(lines)
+                # Backpressure: wait until the client has read enough
+                await writer.drain()
+            writer.write((json.dumps({'nr_samples' : nr_served, 'stopped' : stopped}) + '\n').encode('utf-8'))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # Client went away, its stream ends here
+            pass
+        finally:
+            if producer is not None:
+                producer.cancel()
+            writer.close()
+
+    def run_in_thread(self):
+        # Serve from an event loop in a daemon thread, for clients in the same process.
+        # Returns once the server accepts connections
+        started = threading.Event()
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.close())
+            self.loop.close()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return(self.address())
+
+    def stop_thread(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class SampleClient():
+    """
+    Blocking client, for training loops. Every stream is a connection of its own.
+    """
+    def __init__(self, socket_path=None, host='127.0.0.1', port=DEFAULT_PORT, timeout=None):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        # Seed and settings of the last stream, to reproduce it
+        self.seed = None
+        self.settings = None
+
+    def connect(self):
+        if self.socket_path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        else:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        return(sock)
+
+    def stream(self, nr_samples=None, seed=None, **settings):
+        # Yield (source, target) pairs; endless without nr_samples. Closing the generator
+        # closes the connection, which stops the stream on the server
+        request = dict(settings, nr_samples=nr_samples, seed=seed)
+        with self.connect() as sock, sock.makefile('r', encoding='utf-8', newline='\n') as f:
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            header = json.loads(f.readline() or '{"error" : "Connection closed"}')
+            if 'error' in header:
+                raise SampleServerError(header['error'])
+            self.seed = header['seed']
+            self.settings = header['settings']
+
+            for line in f:
+                if line.startswith('{'):
+                    trailer = json.loads(line)
+                    if trailer['stopped'] is not None and trailer['stopped'].startswith('error: '):
+                        raise SampleServerError(trailer['stopped'][len('error: '):])
+                    return
+                source, target = line.rstrip('\n').split('\t')
+                yield((source, target))
+            raise SampleServerError('Stream ended without trailer')
+
+    def samples(self, nr_samples, seed=None, **settings):
+        return(list(self.stream(nr_samples, seed, **settings)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, help='Serve on this Unix socket, instead of localhost TCP')
+    parser.add_argument('--host', type=str, help='Address to serve on', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='Port to serve on', default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, help='Number of producer processes', default=1)
+    parser.add_argument('--batch_size', type=int, help='Samples generated per producer call', default=1000)
+    parser.add_argument('--buffer_batches', type=int, help='Batches generated ahead per client', default=4)
+    parser.add_argument('--seed', type=int, help='Seed of the seeds of clients that do not send one', default=None)
+    parser.add_argument('--task', type=str, help='Default PCFG SET task', default=DEFAULT_SETTINGS['task'])
+    parser.add_argument('--alphabet_ratio', type=int, help='Default alphabet ratio', default=DEFAULT_SETTINGS['alphabet_ratio'])
+    parser.add_argument('--random_probs', action='store_true', help='Use different random probabilities for each sample by default')
+    parser.add_argument('--placeholder_args', action='store_true', help='Generate placeholder arguments by default')
+    opt = parser.parse_args()
+
+    server = SampleServer(socket_path=opt.socket,
+                          host=opt.host,
+                          port=opt.port,
+                          workers=opt.workers,
+                          batch_size=opt.batch_size,
+                          buffer_batches=opt.buffer_batches,
+                          defaults={'task' : opt.task,
+                                    'alphabet_ratio' : opt.alphabet_ratio,
+                                    'random_probs' : opt.random_probs,
+                                    'placeholder_args' : opt.placeholder_args},
+                          seed=opt.seed)
+    print('Serving samples on ' + (opt.socket if opt.socket else opt.host + ':' + str(opt.port)))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print('Served ' + str(server.nr_samples_served) + ' samples to ' + str(server.nr_clients) + ' clients')
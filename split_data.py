@@ -0,0 +1,73 @@
+"""
+Split a PCFG SET data file into train, dev and test sets.
+
+Each line goes to a split by a hash of its source, so the split is deterministic,
+needs only one pass with constant memory, and keeps identical sources in the same
+split. Writes the random_split/{train,dev,test}.{src,tgt} layout of data/pcfg_set, by
+default into <data file stem>_random_split next to the data file, so that data files
+in the same directory do not overwrite each other's splits.
+
+"""
+
+import argparse
+import hashlib
+import os
+
+SPLITS = ['train', 'dev', 'test']
+
+def split_position(source, salt=''):
+    # Uniform position in [0, 1) for a source
+    digest = hashlib.blake2b((salt + source).encode('utf-8'), digest_size=8).digest()
+    return(int.from_bytes(digest, 'big') / 2 ** 64)
+
+def default_split_dir(data_file):
+    stem = os.path.splitext(os.path.basename(data_file))[0]
+    return(os.path.join(os.path.dirname(data_file), stem + '_random_split'))
+
+def split_data(data_file, train_ratio, dev_ratio=None, split_dir=None, salt=''):
+    # By default the data not used for training is split 1:2 into dev and test
+    if dev_ratio is None:
+        dev_ratio = (1 - train_ratio) / 3
+    if train_ratio + dev_ratio > 1:
+        raise ValueError('train_ratio + dev_ratio must not exceed 1')
+    if split_dir is None:
+        split_dir = default_split_dir(data_file)
+    os.makedirs(split_dir, exist_ok=True)
+
+    files = {}
+    counts = {split : 0 for split in SPLITS}
+    try:
+        for split in SPLITS:
+            files[split] = (open(os.path.join(split_dir, split + '.src'), 'w'),
+                            open(os.path.join(split_dir, split + '.tgt'), 'w'))
+
+        with open(data_file, 'r') as f:
+            for line in f:
+                source, target = line.rstrip('\n').split('\t')
+                position = split_position(source, salt)
+                if position < train_ratio:
+                    split = 'train'
+                elif position < train_ratio + dev_ratio:
+                    split = 'dev'
+                else:
+                    split = 'test'
+                files[split][0].write(source + '\n')
+                files[split][1].write(target + '\n')
+                counts[split] += 1
+    finally:
+        for src_file, tgt_file in files.values():
+            src_file.close()
+            tgt_file.close()
+
+    return(split_dir, counts)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_file', type=str, help='Data file to split', required=True)
+    parser.add_argument('--train_ratio', type=float, help='Fraction of data to use for training', default=0.8)
+    parser.add_argument('--dev_ratio', type=float, help='Fraction of data to use for development (default: a third of the rest)', default=None)
+    parser.add_argument('--split_dir', type=str, help='Output directory (default: <data file stem>_random_split next to the data file)', default=None)
+    opt = parser.parse_args()
+
+    split_dir, counts = split_data(opt.data_file, opt.train_ratio, opt.dev_ratio, opt.split_dir)
+    print('Split ' + ', '.join(split + ': ' + str(counts[split]) for split in SPLITS) + ' into ' + split_dir)
@@ -0,0 +1,39 @@
+import pytest
+
+from arguments import KeyedPermutation, ArgumentAllocator, ArgumentSpaceExhausted
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 16, 26, 100, 676, 1000, 4097])
+def test_permutation_is_bijection(size):
+    for key in range(3):
+        permutation = KeyedPermutation(size, key)
+        assert sorted(permutation[idx] for idx in range(size)) == list(range(size))
+
+def test_permutation_depends_on_key():
+    assert [KeyedPermutation(1000, 1)[idx] for idx in range(1000)] != [KeyedPermutation(1000, 2)[idx] for idx in range(1000)]
+
+@pytest.mark.parametrize('nr_shards', [1, 2, 3, 5])
+def test_shards_never_hand_out_same_argument(nr_shards):
+    alphabet = ['a', 'b', 'c', 'd', 'e']
+    drawn = []
+    for shard_idx in range(nr_shards):
+        allocator = ArgumentAllocator(alphabet, key=42)
+        allocator.shard(shard_idx, nr_shards)
+        for length in [1, 2, 3]:
+            while allocator.remaining(length):
+                drawn.append(tuple(allocator.draw(length)))
+            with pytest.raises(ArgumentSpaceExhausted):
+                allocator.draw(length)
+    assert len(drawn) == len(set(drawn))
+    # Together the shards hand out every argument
+    assert len(drawn) == 5 + 5 ** 2 + 5 ** 3
+
+def test_state_continues_same_arguments():
+    allocator = ArgumentAllocator(['a', 'b', 'c'], key=7, shard_idx=1, nr_shards=2)
+    first = [allocator.draw(3) for i in range(4)]
+    state = allocator.get_state()
+    rest = [allocator.draw(3) for i in range(5)]
+
+    resumed = ArgumentAllocator(['a', 'b', 'c'], key=7)
+    resumed.set_state(state)
+    assert [resumed.draw(3) for i in range(5)] == rest
+    assert not set(map(tuple, first)) & set(map(tuple, rest))
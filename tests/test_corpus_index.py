@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+
+import tree_stats
+from corpus_index import CorpusIndex, INDEX_VERSION, index_file
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'pcfg_set', '10K')
+DATA_FILE = os.path.join(DATA_DIR, 'pcfg_10funcs_520letters.txt')
+BRACKETS_FILE = os.path.join(DATA_DIR, 'pcfg_10funcs_520letters_brackets.txt')
+
+@pytest.fixture(scope='module')
+def indexes():
+    return(CorpusIndex(DATA_FILE, use_cache=False), CorpusIndex(BRACKETS_FILE, use_cache=False))
+
+def test_files_with_and_without_brackets_give_same_index(indexes):
+    plain, bracketed = indexes
+    assert len(plain) == len(bracketed) == 9152
+    assert np.array_equal(plain.depths, bracketed.depths)
+    assert np.array_equal(plain.lengths, bracketed.lengths)
+    assert np.array_equal(plain.function_counts, bracketed.function_counts)
+    assert np.array_equal(plain.pair_words, bracketed.pair_words)
+    # Without brackets, every sample used to get depth 1
+    assert plain.depths.max() > 2
+
+def test_depths_and_lengths_follow_brackets(indexes):
+    plain, bracketed = indexes
+    depths, lengths = tree_stats.compute_statistics(BRACKETS_FILE)
+    assert np.array_equal(bracketed.depths, depths)
+    assert np.array_equal(bracketed.lengths, lengths)
+
+def test_index_of_other_version_is_rebuilt(tmp_path):
+    data_file = str(tmp_path / 'data.txt')
+    with open(BRACKETS_FILE, 'r') as fin, open(data_file, 'w') as fout:
+        fout.writelines(line for idx, line in zip(range(100), fin))
+    index = CorpusIndex(data_file)
+    with np.load(index_file(data_file)) as stored:
+        arrays = {name : stored[name] for name in stored.files}
+    assert arrays['version'] == INDEX_VERSION
+
+    # An index of before the version key, with wrong depths
+    del arrays['version']
+    arrays['depths'] = np.ones_like(arrays['depths'])
+    np.savez(index_file(data_file), **arrays)
+    assert np.array_equal(CorpusIndex(data_file).depths, index.depths)
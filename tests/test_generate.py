@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+import generate
+import tasks
+from generate import MarkovTree, generate_data, generate_data_parallel, checkpoint_file, probe_old_filters, OLD_MAX_DEPTH
+
+def markov_tree(seed=0, prob_func=0.25, omit_brackets=False, **budgets):
+    task = tasks.default
+    return(MarkovTree(unary_functions=task.unary_functions,
+                      binary_functions=task.binary_functions,
+                      alphabet=[letter + str(i) for letter in task.alphabet for i in range(1, 21)],
+                      prob_unary=0.75,
+                      prob_func=prob_func,
+                      lengths=[2, 3, 4, 5],
+                      placeholders=False,
+                      omit_brackets=omit_brackets,
+                      seed=seed,
+                      **budgets))
+
+def test_budgets_keep_samples_within_limits():
+    t = markov_tree(prob_func=0.6, max_length=200, max_depth=6)
+    for i in range(500):
+        tree = t.build()
+        assert len(t.write(tree)) < 200
+        assert t.tree_statistics(tree)[0] - 1 <= 6
+
+def test_probe_counts_old_rejections_without_touching_generator():
+    t = markov_tree(prob_func=0.9, max_length=500, max_depth=20)
+    state = t.get_state()
+    counts = probe_old_filters(t, 300, random_probs=False, seed=1)
+    assert t.get_state() == state
+    assert counts['probed'] == 300
+    assert counts['too_deep'] > 0 and counts['too_long'] > 0
+    assert counts == probe_old_filters(t, 300, random_probs=False, seed=1)
+
+def test_probe_fails_where_old_recursion_limit_did():
+    t = markov_tree(prob_func=0.9)
+    t.set_budgets(None, OLD_MAX_DEPTH)
+    t.raise_past_depth = True
+    nr_too_deep = 0
+    for i in range(300):
+        try:
+            tree = t.build()
+        except RecursionError:
+            nr_too_deep += 1
+            continue
+        assert t.tree_statistics(tree)[0] - 1 <= OLD_MAX_DEPTH
+    assert nr_too_deep > 0
+
+def budgeted_tree():
+    # The budgets of generate.py, without them random probabilities make endless trees
+    return(markov_tree(max_length=500, max_depth=20))
+
+def interrupt_after(monkeypatch, nr_calls):
+    # Stand-in for a crash: sample_line fails after nr_calls calls (per process)
+    real_sample_line = generate.sample_line
+    calls = [0]
+    def interrupted(*args, **kwargs):
+        calls[0] += 1
+        if calls[0] > nr_calls:
+            raise RuntimeError('Interrupted')
+        return(real_sample_line(*args, **kwargs))
+    monkeypatch.setattr(generate, 'sample_line', interrupted)
+
+def read(file):
+    with open(file, 'rb') as f:
+        return(f.read())
+
+@pytest.mark.parametrize('random_probs', [False, True])
+def test_resumed_run_is_same_as_uninterrupted(tmp_path, monkeypatch, random_probs):
+    expected = read(generate_data(budgeted_tree(), 1000, str(tmp_path / 'full'), random_probs))
+
+    data_root = str(tmp_path / 'resumed')
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 730)
+        with pytest.raises(RuntimeError):
+            generate_data(budgeted_tree(), 1000, data_root, random_probs, checkpoint_every=100)
+    assert os.path.exists(checkpoint_file(data_root))
+    assert read(data_root + '.txt') != expected
+    assert read(generate_data(budgeted_tree(), 1000, data_root, random_probs, checkpoint_every=100, resume=True)) == expected
+
+@pytest.mark.parametrize('random_probs', [False, True])
+def test_resumed_parallel_run_is_same_as_uninterrupted(tmp_path, monkeypatch, random_probs):
+    expected = read(generate_data_parallel(budgeted_tree(), 1000, str(tmp_path / 'full'), random_probs, workers=2, seed=5))
+
+    data_root = str(tmp_path / 'resumed')
+    with monkeypatch.context() as patch:
+        interrupt_after(patch, 330)
+        with pytest.raises(RuntimeError):
+            generate_data_parallel(budgeted_tree(), 1000, data_root, random_probs, workers=2, seed=5, checkpoint_every=100)
+    assert not os.path.exists(data_root + '.txt')
+    assert all(os.path.exists(checkpoint_file(data_root + '_shard' + str(i))) for i in range(2))
+    output_file = generate_data_parallel(budgeted_tree(), 1000, data_root, random_probs, workers=2, seed=5,
+                                         checkpoint_every=100, resume=True)
+    assert read(output_file) == expected
+    assert sorted(os.listdir(tmp_path)) == ['full.txt', 'resumed.txt']
+
+def test_write_and_evaluate_trees_too_deep_for_recursion():
+    t = markov_tree()
+    reverse, append = t.unary_functions[1], t.binary_functions[0]
+    tree = ['A1', 'B1']
+    for i in range(5000):
+        tree = [reverse, tree] if i % 2 else [append, ['C1'], tree]
+    source, output = t.write_and_evaluate(tree)
+    assert (source, output) == t.write_and_evaluate_iterative(tree)
+    assert source.count('reverse') == 2500 and source.count('append') == 2500
+    assert sorted(output) == sorted(['A1', 'B1'] + ['C1'] * 2500)
+
+def test_write_and_evaluate_paths_agree():
+    for omit_brackets in [False, True]:
+        t = markov_tree(prob_func=0.5, omit_brackets=omit_brackets, max_length=500, max_depth=20)
+        for i in range(2000):
+            tree = t.build()
+            assert t.write_and_evaluate(tree) == t.write_and_evaluate_iterative(tree)
@@ -0,0 +1,83 @@
+import http.server
+import json
+import threading
+
+import pytest
+
+import tasks
+from naturalize import DataNaturalization, DependencyStatsCache
+
+class FakeCoreNLPHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every sentence with a chain of dependencies, one arc per word, so a
+    sentence of n words has depth n and length n.
+    """
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        sentence = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.server.requests.append(sentence)
+        arcs = [{'dependent' : idx + 1, 'governor' : idx} for idx in range(len(sentence.split()))]
+        body = json.dumps({'sentences' : [{'basicDependencies' : arcs}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def corenlp_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeCoreNLPHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield(server)
+    server.shutdown()
+    server.server_close()
+
+def write_nl_file(path, sentences):
+    # The sentencepiece format that DataLoader decodes
+    with open(path, 'w') as f:
+        for sentence in sentences:
+            f.write(''.join('▁' + word for word in sentence.split()) + '\n')
+
+def test_tree_statistics_are_parsed_once(tmp_path, corenlp_server):
+    sentences = ['the cat sat', 'a dog', 'the cat sat', 'birds fly over the hills']
+    nl_file = str(tmp_path / 'nl.txt')
+    write_nl_file(nl_file, sentences)
+    naturalizer = DataNaturalization(tasks.default.alphabet, tasks.default.unary_functions, tasks.default.binary_functions)
+    server_url = 'http://127.0.0.1:' + str(corenlp_server.server_address[1])
+
+    depths, lengths = naturalizer.get_tree_statistics(nl_file, type='nl', server_url=server_url, workers=4)
+    expected = [len(sentence.split()) for sentence in sentences]
+    assert depths == expected
+    assert lengths == expected
+    # Repeated sentences are parsed once
+    assert sorted(corenlp_server.requests) == sorted(set(sentences))
+
+    nr_requests = len(corenlp_server.requests)
+    assert naturalizer.get_tree_statistics(nl_file, type='nl', server_url=server_url, workers=4) == (depths, lengths)
+    assert len(corenlp_server.requests) == nr_requests
+
+def test_cache_drops_line_cut_off_by_crash(tmp_path):
+    path = str(tmp_path / 'nl.txt.depstats')
+    cache = DependencyStatsCache(path)
+    cache.add('the cat sat', 3, 3)
+    cache.close()
+    with open(path, 'a') as f:
+        f.write(cache.key('a dog') + '\t2')
+
+    cache = DependencyStatsCache(path)
+    assert 'the cat sat' in cache
+    assert not 'a dog' in cache
+    cache.add('a dog', 2, 2)
+    cache.close()
+
+    cache = DependencyStatsCache(path)
+    assert cache['the cat sat'] == (3, 3)
+    assert cache['a dog'] == (2, 2)
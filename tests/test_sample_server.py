@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+
+from generate import generate_data
+from sample_server import SampleServer, SampleClient, SampleServerError, make_tree, DEFAULT_SETTINGS
+
+@pytest.fixture
+def server():
+    server = SampleServer(port=0, batch_size=100, buffer_batches=2, seed=0)
+    server.run_in_thread()
+    yield(server)
+    server.stop_thread()
+
+@pytest.fixture
+def client(server):
+    return(SampleClient(port=server.port, timeout=30))
+
+def generated_pairs(tmp_path, settings, seed, nr_samples):
+    data_root = str(tmp_path / 'data')
+    generate_data(make_tree(settings, seed), nr_samples, data_root, settings['random_probs'])
+    with open(data_root + '.txt', 'r') as f:
+        return([tuple(line.rstrip('\n').split('\t')) for line in f])
+
+@pytest.mark.parametrize('settings', [{}, {'random_probs' : True, 'max_length' : 60}, {'omit_brackets' : True}])
+def test_stream_is_generate_data_of_its_seed(tmp_path, client, settings):
+    pairs = client.samples(250, seed=7, **settings)
+    assert client.seed == 7
+    expected = generated_pairs(tmp_path, dict(DEFAULT_SETTINGS, **settings), 7, 250)
+    # generate_data counts samples dropped for max_length, the stream makes up for them
+    assert pairs[:len(expected)] == expected
+    assert len(pairs) == 250
+
+def test_stream_without_seed_is_reproducible(client):
+    pairs = client.samples(50)
+    assert client.samples(50, seed=client.seed) == pairs
+
+@pytest.mark.parametrize('settings', [{'bogus' : 1}, {'task' : 'bogus'}, {'max_length' : 5}, {'nr_samples' : -1}])
+def test_invalid_settings_give_error(client, settings):
+    with pytest.raises(SampleServerError):
+        client.samples(**dict({'nr_samples' : 10}, **settings))
+
+def stream_tasks(server):
+    # Names of the tasks of the streams on the event loop of the server
+    async def names():
+        return([task.get_coro().__qualname__ for task in asyncio.all_tasks() if task is not asyncio.current_task()])
+    return(asyncio.run_coroutine_threadsafe(names(), server.loop).result())
+
+def test_disconnect_stops_producer(server, client):
+    stream = client.stream()
+    for i in range(1000):
+        next(stream)
+    assert 'SampleServer.produce' in stream_tasks(server)
+    stream.close()
+
+    deadline = time.monotonic() + 10
+    while stream_tasks(server) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert stream_tasks(server) == []
+    nr_served = server.nr_samples_served
+    time.sleep(0.5)
+    assert server.nr_samples_served == nr_served
+    # The server still serves other clients
+    assert len(client.samples(10)) == 10
@@ -0,0 +1,135 @@
+"""
+Depth and length statistics of PCFG SET data files, for a whole file at once.
+
+For sources with brackets, gives the same numbers as naturalize.DependencyParsePCFG:
+the length of a sample is its number of source tokens other than brackets, its depth
+the maximum number of open brackets plus one. Sources are encoded as bytes and the
+bracket depth follows from a cumulative sum, so there is no loop over tokens.
+
+Sources without brackets differ: DependencyParsePCFG gives them all depth 1, but here
+they get the depth they would have with brackets, the nesting of function calls plus
+one, read by the arity of the functions of the task (as MarkovTree.tree_statistics
+counts it). Results are stored in a sidecar file next to the data (<file>.stats.npz),
+which is recomputed when the size or modification time of the data file changes.
+
+"""
+
+import os
+import numpy as np
+
+import tasks
+
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[ord(' '), ord('\t'), ord('\n'), ord('\r'), ord('\x0b'), ord('\x0c')]] = True
+BRACKET_STEPS = np.zeros(256, dtype=np.int32)
+BRACKET_STEPS[ord('(')] = 1
+BRACKET_STEPS[ord(')')] = -1
+
+def function_arities(task):
+    arities = {func.__name__.encode('utf-8') : 1 for func in task.unary_functions}
+    arities.update({func.__name__.encode('utf-8') : 2 for func in task.binary_functions})
+    return(arities)
+
+DEFAULT_ARITIES = function_arities(tasks.default)
+
+def nesting_depth(tokens, arities):
+    # Most function calls open at once, plus one, for tokens without brackets. A call
+    # is open until its last argument ends, and a string argument ends at the next
+    # token that is not part of a string
+    open_args = []
+    max_open = 0
+    in_string = False
+    for token in tokens:
+        arity = arities.get(token)
+        if arity is None and token != b',':
+            in_string = True
+            continue
+        if in_string:
+            in_string = False
+            while open_args:
+                open_args[-1] -= 1
+                if open_args[-1]:
+                    break
+                open_args.pop()
+        if arity is not None:
+            open_args.append(arity)
+            max_open = max(max_open, len(open_args))
+    return(max_open + 1)
+
+def sources_statistics(sources, arities=DEFAULT_ARITIES):
+    # Depths and lengths for a list of sources (bytes), all lines processed together
+    if not sources:
+        return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    # Every source is followed by a newline, so no line is empty
+    data = np.frombuffer(b'\n'.join(sources) + b'\n', dtype=np.uint8)
+    line_ends = np.flatnonzero(data == ord('\n'))
+    line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+
+    is_token_byte = ~WHITESPACE[data]
+    token_starts = is_token_byte.copy()
+    token_starts[1:] &= ~is_token_byte[:-1]
+    nr_tokens = np.add.reduceat(token_starts.astype(np.int64), line_starts)
+
+    steps = BRACKET_STEPS[data]
+    nr_brackets = np.add.reduceat(np.abs(steps).astype(np.int64), line_starts)
+
+    # Open brackets after each byte, relative to the start of its line
+    open_brackets = np.cumsum(steps)
+    line_offsets = np.concatenate([[0], open_brackets[line_ends[:-1]]])
+    line_ids = np.repeat(np.arange(len(line_starts)), line_ends - line_starts + 1)
+    open_brackets -= line_offsets[line_ids]
+    depths = np.maximum(np.maximum.reduceat(open_brackets, line_starts), 0) + 1
+    depths = depths.astype(np.int64)
+    for line_idx in np.flatnonzero(nr_brackets == 0).tolist():
+        depths[line_idx] = nesting_depth(sources[line_idx].split(), arities)
+
+    return(depths, nr_tokens - nr_brackets)
+
+def compute_statistics(file, chunk_lines=1000000):
+    depths, lengths = [], []
+    with open(file, 'rb') as f:
+        sources = []
+        for line in f:
+            sources.append(line.split(b'\t', 1)[0].rstrip(b'\n'))
+            if len(sources) == chunk_lines:
+                chunk_depths, chunk_lengths = sources_statistics(sources)
+                depths.append(chunk_depths)
+                lengths.append(chunk_lengths)
+                sources = []
+        chunk_depths, chunk_lengths = sources_statistics(sources)
+        depths.append(chunk_depths)
+        lengths.append(chunk_lengths)
+    return(np.concatenate(depths), np.concatenate(lengths))
+
+# Sidecars of another version are recomputed; version 2 fixed depths without brackets
+SIDECAR_VERSION = 2
+
+def sidecar_file(file):
+    return(file + '.stats.npz')
+
+def file_signature(file):
+    stat = os.stat(file)
+    return(np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64))
+
+def get_statistics(file, use_cache=True):
+    # Depths and lengths of all samples in file, from the sidecar if it is up to date
+    signature = file_signature(file)
+    sidecar = sidecar_file(file)
+    if use_cache and os.path.exists(sidecar):
+        try:
+            with np.load(sidecar) as stored:
+                if np.array_equal(stored['signature'], signature) and stored['version'] == SIDECAR_VERSION:
+                    return(stored['depths'], stored['lengths'])
+        except (OSError, KeyError, ValueError):
+            pass
+
+    depths, lengths = compute_statistics(file)
+    if use_cache:
+        try:
+            # Write under a temporary name first, so readers never see half a sidecar
+            temporary = sidecar + '.tmp.npz'
+            np.savez(temporary, version=SIDECAR_VERSION, signature=signature, depths=depths, lengths=lengths)
+            os.replace(temporary, sidecar)
+        except OSError:
+            pass
+    return(depths, lengths)